@@ -0,0 +1,99 @@
+import logging, time
+
+from collections import OrderedDict
+
+from cache import JsonFileStore, SnapshotDict, snapshot_store
+from pipeline import parallel_map
+from uploader import merge_esdr_uploads, split_esdr_upload
+
+# Rows per ESDR PUT when uploading backfilled data.
+MAX_ROWS_PER_UPLOAD = 5000
+
+def split_range(start, end, window):
+    # [(window_start, window_end)] covering start..end in steps of window.
+    windows = []
+    while start < end:
+        windows.append((start, min(start + window, end)))
+        start += window
+    return windows
+
+class CheckpointStore(object):
+    # Keys of the finished tasks of each backfill job, kept in `store` (memory
+    # by default) so a deadline-killed request picks up where it stopped.
+    def __init__(self, store=None):
+        self.jobs = SnapshotDict(store or JsonFileStore(None))
+
+    def done(self, job_id):
+        with self.jobs.using([job_id]) as jobs:
+            return set(jobs.get(job_id, []))
+
+    def mark_done(self, job_id, keys):
+        with self.jobs.using([job_id]) as jobs:
+            jobs[job_id] = sorted(set(jobs.get(job_id, [])) | set(keys))
+            self.jobs.save([job_id])
+
+# Shared by every instance, so a repeated backfill request resumes the job
+# wherever it lands, even after the last one was killed at the deadline.
+checkpoints = CheckpointStore(snapshot_store('backfill'))
+
+class Backfill(object):
+    # Runs fetch(task) for every task of a job that isn't checkpointed yet,
+    # `concurrency` at a time.  fetch returns [(feed, esdr_data)].  The rows of
+    # each batch of tasks are merged per feed and uploaded as multi-row PUTs
+    # before the batch is checkpointed, so a killed request loses at most one
+    # batch, which the next run redoes.  No batch is started that the slowest
+    # batch so far says won't finish before `deadline`.
+    def __init__(self, job_id, tasks, fetch, upload, key=str, concurrency=4, batch_size=None,
+                 deadline=None, checkpoints=checkpoints):
+        self.job_id = job_id
+        self.tasks = tasks
+        self.fetch = fetch
+        self.upload = upload
+        self.key = key
+        self.concurrency = concurrency
+        self.batch_size = batch_size or 4 * concurrency
+        self.deadline = deadline
+        self.checkpoints = checkpoints
+
+    def run_task(self, task):
+        try:
+            return task, self.fetch(task)
+        except Exception as e:
+            logging.warning('Backfill %s: %s failed, will retry next run: %s' % (self.job_id, self.key(task), e))
+            return task, None
+
+    def run(self):
+        done = self.checkpoints.done(self.job_id)
+        pending = [task for task in self.tasks if self.key(task) not in done]
+        progress = OrderedDict([
+            ('job', self.job_id),
+            ('tasks', len(self.tasks)),
+            ('done', len(self.tasks) - len(pending)),
+            ('failed', 0),
+            ('rows', 0),
+        ])
+        slowest_batch = 0
+        while pending:
+            if self.deadline is not None and time.time() + slowest_batch > self.deadline:
+                logging.info('Backfill %s: stopping for the request deadline' % self.job_id)
+                break
+            batch_started = time.time()
+            batch, pending = pending[:self.batch_size], pending[self.batch_size:]
+            completed = []
+            feeds = OrderedDict()
+            for task, results in parallel_map(self.run_task, batch, self.concurrency):
+                if results is None:
+                    progress['failed'] += 1
+                    continue
+                completed.append(task)
+                for feed, esdr_data in results:
+                    feeds.setdefault(feed['id'], (feed, []))[1].append(esdr_data)
+            for feed, uploads in feeds.values():
+                for chunk in split_esdr_upload(merge_esdr_uploads(uploads), MAX_ROWS_PER_UPLOAD):
+                    self.upload(feed, chunk)
+                    progress['rows'] += len(chunk['data'])
+            self.checkpoints.mark_done(self.job_id, [self.key(task) for task in completed])
+            progress['done'] += len(completed)
+            slowest_batch = max(slowest_batch, time.time() - batch_started)
+        progress['complete'] = progress['done'] == progress['tasks']
+        return progress
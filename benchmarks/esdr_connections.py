@@ -0,0 +1,138 @@
+"""Counts TCP connections opened against a local stub ESDR server per scrape.
+
+Run from the repository root:
+
+    python benchmarks/esdr_connections.py [feeds]
+
+The stub answers the handful of ESDR endpoints a connector run touches (token,
+product, device, feed lookups and uploads).  The same simulated scrape is run
+once with a fresh connection per call, as Esdr.api used to do with the
+module-level requests functions, and once with the pooled keep-alive session.
+
+The monkeypatch is disabled so urllib3's socket pool is measured.  On App
+Engine every call goes through urlfetch whatever the pool size, so these
+numbers don't apply there.
+"""
+import json, os, re, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Outside App Engine there is no urlfetch; keep urllib3's own socket pool.
+from requests_toolbelt.adapters import appengine
+appengine.monkeypatch = lambda *args, **kwargs: None
+
+import requests
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import esdr
+from esdr import Esdr
+
+class StubEsdrHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body in one segment so keep-alive isn't penalised by delayed ACKs.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    connections = 0
+    requests = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with StubEsdrHandler.lock:
+            StubEsdrHandler.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body):
+        with StubEsdrHandler.lock:
+            StubEsdrHandler.requests += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        self.reply({'access_token': 'stub', 'refresh_token': 'stub', 'expires_in': 3600})
+
+    def do_PUT(self):
+        self.reply({'code': 200, 'status': 'success', 'data': {}})
+
+    def do_GET(self):
+        match = re.search(r'serialNumber%3D([^&]+)|serialNumber=([^&]+)', self.path)
+        if self.path.startswith('/api/v1/products'):
+            rows = [{'id': 1, 'name': 'Stub'}]
+        elif self.path.startswith('/api/v1/devices') and match:
+            serial = match.group(1) or match.group(2)
+            rows = [{'id': abs(hash(serial)) % 100000, 'name': serial, 'productId': 1}]
+        else:
+            rows = [{'id': 1, 'name': 'Stub feed', 'latitude': None, 'longitude': None}]
+        self.reply({'data': {'totalCount': len(rows), 'rows': rows}})
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class OneShotSession(object):
+    # What Esdr.api did before: requests.get/post/put, one connection per call.
+    def request(self, method, url, **kwargs):
+        return requests.request(method, url, **kwargs)
+
+def scrape(client, feeds):
+    product = client.get_product_by_name('Stub')
+    for i in range(feeds):
+        device = client.get_device_by_serial_number(product, 'device_%d' % i)
+        feed = client.get_feed(device)
+        client.upload(feed, {'channel_names': ['a'], 'data': [[time.time(), i]]})
+
+def measure(label, make_client, feeds, runs):
+    StubEsdrHandler.connections = 0
+    StubEsdrHandler.requests = 0
+    start = time.time()
+    for _ in range(runs):
+        # A new client per run, like Connector.initialize_connector.
+        scrape(make_client(), feeds)
+    elapsed = time.time() - start
+    print('%-10s %4d requests  %4d connections  %.1f connections/scrape  %.3f s/scrape' % (
+        label, StubEsdrHandler.requests, StubEsdrHandler.connections,
+        StubEsdrHandler.connections / float(runs), elapsed / runs))
+
+def main():
+    feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    runs = 5
+    server = ThreadingServer(('127.0.0.1', 0), StubEsdrHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    prefix = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    auth_file = tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False)
+    json.dump({'grant_type': 'password', 'client_id': 'stub', 'client_secret': 'stub',
+               'username': 'stub', 'password': 'stub'}, auth_file)
+    auth_file.close()
+    try:
+        def unpooled():
+            client = Esdr(auth_file.name, prefix=prefix)
+            client.session = OneShotSession()
+            return client
+        measure('unpooled', unpooled, feeds, runs)
+        measure('pooled', lambda: Esdr(auth_file.name, prefix=prefix), feeds, runs)
+    finally:
+        os.unlink(auth_file.name)
+        for session in esdr._sessions.values():
+            session.close()
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
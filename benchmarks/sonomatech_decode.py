@@ -0,0 +1,72 @@
+"""Compares decoding a Sonoma Tech data response once with the old handling.
+
+Run from the repository root:
+
+    python benchmarks/sonomatech_decode.py [hours]
+
+Builds a synthetic /data/filterAsJson response for Chevron's sites and
+parameters with one 5 minute row per site and parameter over the given number
+of hours (24 by default, a catch-up sized window) and times:
+
+- the old handling: response.json() for the auth check, the 'data' check and
+  the result;
+- response.json() once;
+- decode_body, json.loads on the raw bytes, once.
+"""
+import datetime, json, os, random, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Outside App Engine there is no urlfetch; nothing here makes requests anyway.
+from requests_toolbelt.adapters import appengine
+appengine.monkeypatch = lambda *args, **kwargs: None
+
+from requests.models import Response
+
+from chevron import ChevronUploader
+from sonomatech import check_body, decode_body
+
+def make_response(hours):
+    start = datetime.datetime(2019, 5, 1)
+    rows = []
+    for i in range(int(hours * 12)):
+        utc = (start + datetime.timedelta(minutes=5 * i)).strftime('%Y-%m-%d %H:%M:%S')
+        for site_id in ChevronUploader.SITE_IDS:
+            for group in ChevronUploader.PARAMETER_GROUPS:
+                for parameter in group:
+                    rows.append({
+                        'siteId': site_id,
+                        'siteName': 'Site %d' % site_id,
+                        'latitude': 37.9 + site_id / 1000.0,
+                        'longitude': -122.3 - site_id / 1000.0,
+                        'utc': utc,
+                        'parameterName': 'Parameter-%d' % parameter,
+                        'qcCode': random.choice([0, 0, 0, 9]),
+                        'value': round(random.uniform(0, 100), 2),
+                    })
+    response = Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps({'data': rows, 'error': False, 'isFailure': False})
+    return response, len(rows)
+
+def old_handling(response):
+    body = response.json()
+    if 'data' not in response.json():
+        raise Exception('The server omitted data field.')
+    return response.json()['data']
+
+def main():
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 24
+    response, row_count = make_response(hours)
+    print('%d rows, %.1f MB' % (row_count, len(response.content) / 1e6))
+    for label, handle in [
+        ('old (3 decodes)', old_handling),
+        ('response.json()', lambda response: check_body(response.json(), 'data')),
+        ('decode_body', lambda response: check_body(decode_body(response), 'data')),
+    ]:
+        elapsed = min(timeit.repeat(lambda: handle(response), number=1, repeat=5))
+        print('%-16s %.3f s  %.2f us/row' % (label, elapsed, 1e6 * elapsed / row_count))
+
+if __name__ == '__main__':
+    main()
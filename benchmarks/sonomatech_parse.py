@@ -0,0 +1,106 @@
+"""Compares the indexed Sonoma Tech parse_devices with the old per-row one.
+
+Run from the repository root:
+
+    python benchmarks/sonomatech_parse.py [hours]
+
+Parses a synthetic /data/filterAsJson window for Chevron's sites and
+parameters, one 5 minute row per site and parameter over the given number of
+hours (24 by default, a backfill sized window).  Feeds resolve through the
+real feed_cache, already warm, as on a busy instance.
+"""
+import datetime, os, random, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Outside App Engine there is no urlfetch; nothing here makes requests anyway.
+from requests_toolbelt.adapters import appengine
+appengine.monkeypatch = lambda *args, **kwargs: None
+
+from chevron import ChevronUploader
+from sonomatech import Feed, QcCodeHistory, QcCodeUploads
+from timeutil import utc_to_epoch
+from uploader import feed_cache
+
+class BenchmarkUploader(ChevronUploader):
+    # Upload every QC code, like the old parse, so the outputs compare.
+    QC_KEYFRAME_INTERVAL = None
+
+    def __init__(self):
+        self.product = {'id': 1}
+        self.qc_codes = QcCodeUploads(QcCodeHistory())
+
+    def getFeed(self, id, name, lat, lon):
+        key = feed_cache.makeKey(self.product, id, lat, lon)
+        feed = feed_cache.get(key)
+        if feed is None:
+            feed = {'id': abs(hash(id)) % 100000, 'name': name}
+            feed_cache.set(key, feed)
+        return feed
+
+def old_parse_devices(self, devices):
+    # parse_devices before the site index, with timeutil already in place.
+    raw_data_cache = {}
+    feed_time_cache = {}
+    for device in devices:
+        try:
+            lat = float(device['latitude'])
+            lon = float(device['longitude'])
+        except:
+            pass
+        id = self.makeId(device['siteId'], lat, lon)
+        name = device['siteName']
+        time = utc_to_epoch(device['utc'])
+        param_name = device['parameterName'].replace('-', '_')
+        qc_feed = Feed(id + '_qc', name + '_qc', lat, lon)
+        raw_data_cache.setdefault((qc_feed, time), []).append(device)
+        qc_data = feed_time_cache.setdefault((qc_feed, time), {})
+        qc_data['time'] = time
+        qc_data[param_name + '_qcCode'] = device['qcCode']
+        if not device['qcCode'] == 9:
+            feed = Feed(id, name, lat, lon)
+            raw_data_cache.setdefault((feed, time), []).append(device)
+            data = feed_time_cache.setdefault((feed, time), {})
+            data['time'] = time
+            data[param_name] = device['value']
+    for feedtime, data in feed_time_cache.iteritems():
+        feed, time = feedtime
+        yield self.getFeed(*feed), self.makeEsdrUpload(data), raw_data_cache[(feed, time)]
+
+def make_devices(hours):
+    start = datetime.datetime(2019, 5, 1)
+    devices = []
+    for i in range(int(hours * 12)):
+        utc = (start + datetime.timedelta(minutes=5 * i)).strftime('%Y-%m-%d %H:%M:%S')
+        for site_id in ChevronUploader.SITE_IDS:
+            for group in ChevronUploader.PARAMETER_GROUPS:
+                for parameter in group:
+                    devices.append({
+                        'siteId': site_id,
+                        'siteName': 'Site %d' % site_id,
+                        'latitude': 37.9 + site_id / 1000.0,
+                        'longitude': -122.3 - site_id / 1000.0,
+                        'utc': utc,
+                        'parameterName': 'Parameter-%d' % parameter,
+                        'qcCode': random.choice([0, 0, 0, 9]),
+                        'value': round(random.uniform(0, 100), 2),
+                    })
+    return devices
+
+def summarize(results):
+    return sorted((feed['id'], esdr_data['data'][0][0], esdr_data['channel_names'], esdr_data['data'], len(raw_data))
+                  for feed, esdr_data, raw_data in results)
+
+def main():
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 24
+    devices = make_devices(hours)
+    uploader = BenchmarkUploader()
+    assert summarize(old_parse_devices(uploader, devices)) == summarize(uploader.parse_devices(devices))
+    print('%d rows' % len(devices))
+    for label, parse in [('per row', lambda: list(old_parse_devices(uploader, devices))),
+                         ('indexed', lambda: list(uploader.parse_devices(devices)))]:
+        elapsed = min(timeit.repeat(parse, number=1, repeat=5))
+        print('%-8s %.3f s  %.2f us/row' % (label, elapsed, 1e6 * elapsed / len(devices)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Compares the columnar ThingSpeak conversion with the old per-row loop.
+
+Run from the repository root:
+
+    python benchmarks/thingspeak_conversion.py [days]
+
+Builds a synthetic feed.json response with one 80 s PurpleAir sample per row
+for the given number of days (30 by default) and times both conversions.
+"""
+import datetime, os, random, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Outside App Engine there is no urlfetch; nothing here makes requests anyway.
+from requests_toolbelt.adapters import appengine
+appengine.monkeypatch = lambda *args, **kwargs: None
+
+from purpleair import PurpleAirUploader
+
+def row_loop(thingspeak_data):
+    # The conversion upload_thingspeak_data used to do, collected into one
+    # multi-row upload.
+    channel_map = {value:key for key, value in thingspeak_data['channel'].items() if 'field' in key}
+    rows = []
+    channel_names = None
+    for feed in thingspeak_data['feeds']:
+        data = {}
+        try:
+            data['time'] = (datetime.datetime.strptime(feed['created_at'], "%Y-%m-%dT%H:%M:%SZ") - datetime.datetime(1970,1,1)).total_seconds()
+        except Exception:
+            continue
+        for key in ['PM2.5 (CF=1)', 'RSSI', 'Uptime', 'Humidity', 'Temperature']:
+            translated_key = key
+            if key == 'PM2.5 (CF=1)':
+                translated_key = 'PM2_5'
+            elif key == 'Temperature':
+                translated_key = 'temp_f'
+            elif key == 'Humidity':
+                translated_key = 'humidity'
+            try:
+                data[translated_key] = float(feed[channel_map[key]])
+            except:
+                pass
+        keys = ['time'] + sorted(set(data.keys()).difference(set(['time'])))
+        channel_names = keys[1:]
+        rows.append([data[key] for key in keys])
+    return {'channel_names': channel_names, 'data': rows}
+
+def make_thingspeak_data(days):
+    start = datetime.datetime(2019, 5, 1)
+    feeds = []
+    for i in range(int(days * 24 * 60 * 60 / 80)):
+        feeds.append({
+            'created_at': (start + datetime.timedelta(seconds=80 * i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'entry_id': i,
+            'field1': '%.2f' % random.uniform(0, 50),
+            'field2': '%.2f' % random.uniform(0, 50),
+            'field3': '%d' % i,
+            'field4': '%d' % random.randint(-90, -30),
+            'field6': '%d' % random.randint(50, 90),
+            'field7': '%d' % random.randint(10, 90),
+        })
+    channel = {
+        'field1': 'PM1.0 (CF=1)', 'field2': 'PM2.5 (CF=1)', 'field3': 'Uptime', 'field4': 'RSSI',
+        'field6': 'Temperature', 'field7': 'Humidity', 'name': 'Benchmark',
+    }
+    return {'channel': channel, 'feeds': feeds}
+
+def main():
+    days = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+    thingspeak_data = make_thingspeak_data(days)
+    uploader = PurpleAirUploader(None, None)
+    assert row_loop(thingspeak_data) == uploader.convert_thingspeak_data(thingspeak_data)
+    print('%d rows' % len(thingspeak_data['feeds']))
+    for label, convert in [('row loop', row_loop), ('columnar', uploader.convert_thingspeak_data)]:
+        elapsed = min(timeit.repeat(lambda: convert(thingspeak_data), number=1, repeat=5))
+        print('%-10s %.3f s  %.2f us/row' % (label, elapsed, 1e6 * elapsed / len(thingspeak_data['feeds'])))
+
+if __name__ == '__main__':
+    main()
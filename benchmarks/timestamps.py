@@ -0,0 +1,89 @@
+"""Times each timestamp conversion call site before and after timeutil.
+
+Run from the repository root:
+
+    python benchmarks/timestamps.py
+
+- Sonoma Tech parse_devices/parse_wind_devices: one 'utc' per row of a 24 h
+  Chevron window (12 distinct strings an hour, ~50k rows).
+- fenceline_rodeo.make_time: one call per run.
+- FencelineMartinezUploader.get_now: one call per run.
+- PurpleAir ThingSpeak created_at (parse_utc_timestamps, now
+  parse_utc_column): 30 days of 80 s rows, all distinct.
+"""
+import calendar, datetime, os, sys, timeit
+
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Outside App Engine there is no urlfetch; nothing here makes requests anyway.
+from requests_toolbelt.adapters import appengine
+appengine.monkeypatch = lambda *args, **kwargs: None
+
+from fenceline_martinez import FencelineMartinezUploader
+from fenceline_rodeo import make_time
+from timeutil import parse_utc_column, utc_to_epoch
+
+def old_sonomatech(values):
+    return [(datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S") - datetime.datetime(1970,1,1)).total_seconds()
+            for value in values]
+
+def new_sonomatech(values):
+    return [utc_to_epoch(value) for value in values]
+
+def old_make_time(date, time):
+    date_time_obj = datetime.datetime.strptime('{} {}'.format(date, time), '%Y_%m_%d %H:%M:%S')
+    timezone = pytz.timezone('America/Los_Angeles')
+    aware = timezone.localize(date_time_obj)
+    return (aware - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+
+def old_get_now():
+    timezone = pytz.timezone('America/Los_Angeles')
+    aware = datetime.datetime.now(tz=timezone)
+    return (aware - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+
+def old_parse_utc_timestamps(values):
+    days = {}
+    times = []
+    for value in values:
+        try:
+            if len(value) != 20 or value[10] != 'T' or value[19] != 'Z':
+                raise ValueError(value)
+            day = days.get(value[:10])
+            if day is None:
+                day = days[value[:10]] = calendar.timegm(datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10])).timetuple())
+            times.append(float(day + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])))
+        except (TypeError, ValueError):
+            times.append(None)
+    return times
+
+def report(label, old, new, calls):
+    # Best of 5 runs, in microseconds per call.
+    old_time = min(timeit.repeat(old, number=1, repeat=5)) * 1e6 / calls
+    new_time = min(timeit.repeat(new, number=1, repeat=5)) * 1e6 / calls
+    print('%-24s %8.2f us -> %8.2f us  (%.1fx)' % (label, old_time, new_time, old_time / new_time))
+
+def main():
+    start = datetime.datetime(2019, 5, 1)
+    sonomatech = [(start + datetime.timedelta(minutes=5 * (i // 175))).strftime('%Y-%m-%d %H:%M:%S')
+                  for i in range(288 * 175)]
+    assert old_sonomatech(sonomatech) == new_sonomatech(sonomatech)
+    report('Sonoma Tech rows', lambda: old_sonomatech(sonomatech), lambda: new_sonomatech(sonomatech), len(sonomatech))
+
+    assert old_make_time('2020_05_17', '15:14:23') == make_time('2020_05_17', '15:14:23')
+    report('Rodeo make_time', lambda: [old_make_time('2020_05_17', '15:14:23') for _ in range(1000)],
+           lambda: [make_time('2020_05_17', '15:14:23') for _ in range(1000)], 1000)
+
+    get_now = FencelineMartinezUploader.__dict__['get_now']
+    report('Martinez get_now', lambda: [old_get_now() for _ in range(1000)],
+           lambda: [get_now(None) for _ in range(1000)], 1000)
+
+    thingspeak = [(start + datetime.timedelta(seconds=80 * i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+                  for i in range(30 * 24 * 45)]
+    assert old_parse_utc_timestamps(thingspeak) == parse_utc_column(thingspeak)
+    report('ThingSpeak created_at', lambda: old_parse_utc_timestamps(thingspeak),
+           lambda: parse_utc_column(thingspeak), len(thingspeak))
+
+if __name__ == '__main__':
+    main()
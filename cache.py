@@ -0,0 +1,183 @@
+import json, logging, os, threading, time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from google.appengine.ext import ndb
+except ImportError:
+    # Outside App Engine (tests, scripts); snapshot_store uses a file or memory.
+    ndb = None
+
+# Directory for snapshots that should outlive an instance (feed resolutions,
+# upload watermarks, ...).  Persistence is disabled when unset.  App Engine's
+# python27 sandbox can't write to disk, so there these stay per-instance
+# memory; state that must be durable and shared, like the outbox, lives in
+# Datastore instead (see snapshot_store).
+CACHE_DIR = os.getenv('AWBA_CACHE_DIR')
+
+def cache_path(name):
+    if not CACHE_DIR:
+        return None
+    return os.path.join(CACHE_DIR, name)
+
+def snapshot_store(name):
+    # The store for a SnapshotDict every instance must share and that must
+    # survive restarts: Datastore on App Engine, elsewhere a JSON file under
+    # AWBA_CACHE_DIR, or memory.
+    if ndb is not None:
+        return DatastoreStore(name)
+    return JsonFileStore(cache_path(name + '.json'))
+
+class LRUCache(object):
+    # Thread-safe, size-bounded map.  Entries older than `ttl` seconds (if set)
+    # are treated as missing; the least recently used entry is evicted first.
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and time.time() >= expires_at:
+                return default
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires_at)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def items(self):
+        now = time.time()
+        with self.lock:
+            return [(key, value) for key, (value, expires_at) in self.entries.items()
+                    if expires_at is None or now < expires_at]
+
+    def __len__(self):
+        return len(self.entries)
+
+class JsonFileStore(object):
+    # A dict snapshotted as JSON on local disk.  Without a path it loads empty
+    # and saves nothing, so callers don't need to special-case persistence.
+    # Only this instance sees it, and it is always read and written whole.
+    shared = False
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, keys=None):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except Exception as e:
+            logging.warning('Ignoring unreadable snapshot %s: %s' % (self.path, e))
+            return {}
+
+    def save(self, data, keys=None):
+        if not self.path:
+            return
+        # Write then rename so a killed request never leaves a torn snapshot.
+        tmp_path = '%s.%d.%d.tmp' % (self.path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logging.warning('Could not save snapshot %s: %s' % (self.path, e))
+
+if ndb is not None:
+    class SnapshotEntry(ndb.Model):
+        # One key of a DatastoreStore.
+        value = ndb.JsonProperty(compressed=True)
+
+class DatastoreStore(object):
+    # A dict kept as one SnapshotEntry per key, shared by every instance and
+    # kept across restarts.  Loads and saves name the keys they need, so runs
+    # working on different keys (Chevron's and Valero's streams, two backfill
+    # jobs) never overwrite each other.
+    shared = True
+
+    def __init__(self, name):
+        self.name = name
+
+    def entity_key(self, key):
+        return ndb.Key(SnapshotEntry, '%s|%s' % (self.name, key))
+
+    def load(self, keys):
+        entities = ndb.get_multi([self.entity_key(key) for key in keys])
+        return dict((key, entity.value) for key, entity in zip(keys, entities) if entity is not None)
+
+    def save(self, data, keys):
+        ndb.put_multi([SnapshotEntry(key=self.entity_key(key), value=data[key]) for key in keys if key in data])
+
+class SnapshotDict(object):
+    # A dict loaded from `store` on first use and written back whole by save(),
+    # shared by the threads of an instance.  `with snapshot as data:` holds
+    # the lock while data is read or changed; save() goes inside it.  decode
+    # and encode convert between the stored dict and what callers keep.
+    # A shared store (DatastoreStore) is read again, and written, only for
+    # the keys named with using(keys) and save(keys), so every instance sees
+    # the others' saves; decode and encode don't apply to it.
+    def __init__(self, store, decode=None, encode=None):
+        self.store = store
+        self.decode = decode
+        self.encode = encode
+        self.data = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            return self.load()
+        except Exception:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+    @contextmanager
+    def using(self, keys):
+        # Like `with snapshot`, with `keys` read again from a shared store.
+        with self.lock:
+            yield self.load(keys)
+
+    def load(self, keys=None):
+        # Callers must hold self.lock.
+        if self.store.shared:
+            if self.data is None:
+                self.data = {}
+            stored = self.store.load(keys)
+            for key in keys:
+                if key in stored:
+                    self.data[key] = stored[key]
+                else:
+                    self.data.pop(key, None)
+        elif self.data is None:
+            data = self.store.load()
+            self.data = self.decode(data) if self.decode else data
+        return self.data
+
+    def save(self, keys=None):
+        # Callers must hold self.lock.
+        if self.store.shared:
+            self.store.save(self.data, keys)
+            return
+        data = self.load()
+        self.store.save(self.encode(data) if self.encode else data)
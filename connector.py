@@ -1,50 +1,143 @@
-import webapp2, json, logging, os, random, time
+import webapp2, json, logging, os, random, requests, time
 
+from cache import LRUCache
 from esdr import Esdr
 from collections import OrderedDict
+from outbox import is_permanent_failure, outbox
+from uploader import FEED_CACHE_TTL
+from watermark import upload_history
 
-def fuzzy_wait(secs):
-     def decorator(func):
-         def wrapper(*args, **kwargs):
-             time.sleep(random.randint(0, secs))
-             return func(*args, **kwargs)
-         return wrapper
-     return decorator
+# ESDR products by PRODUCT_NAME, so warm requests skip the product lookup.
+product_cache = LRUCache(ttl=FEED_CACHE_TTL)
+
+def is_production():
+	return os.getenv('SERVER_SOFTWARE', '').startswith('Google App Engine/')
+
+def is_production_cron(request):
+	return is_production() and request.headers.get('X-AppEngine-Cron')
 
 class Connector(webapp2.RequestHandler):
 	UPLOADER = object
 	PRODUCT_NAME = 'ESDR Product'
+	# Max keep-alive connections held open to ESDR by this connector's session.
+	ESDR_POOL_SIZE = 10
+	# Random delay (seconds) before a run, just enough to de-synchronise cron
+	# jobs firing on the same minute.  Request pacing is left to ratelimit.
+	START_JITTER = 2
+	# Seconds App Engine gives the request; ESDR retries stop in time to respond.
+	REQUEST_DEADLINE = 60
+	# Also drop values equal to the last one uploaded for a channel, for sources
+	# that restamp unchanged readings with the current time.
+	SUPPRESS_UNCHANGED = False
 
-	@fuzzy_wait(10)
 	def get(self):
+		self.started = time.time()
+		time.sleep(random.uniform(0, self.START_JITTER))
 		self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
 		self.initialize_connector()
 		try:
 			response = []
-			for data in self.scrape():
-				if data:
-					feed, esdr_data, raw_data = data
-					self.upload(feed, esdr_data)
-					response.append(OrderedDict({'feed':  '%s (%s)' % (feed['name'], feed['id']), 'esdr_data': esdr_data, 'raw_data': raw_data}));
+			# Batch every row scraped for a feed into one multi-row upload.
+			batches = OrderedDict()
+			scrape_error = None
+			try:
+				for data in self.scrape():
+					if data:
+						feed, esdr_data, raw_data = data
+						_, uploads, raw_batch = batches.setdefault(feed['id'], (feed, [], []))
+						uploads.append(esdr_data)
+						raw_batch.append(raw_data)
+			except Exception as e:
+				# Still upload (or queue) the rows scraped before the failure.
+				logging.error(e, exc_info=True)
+				scrape_error = str(e)
+			# Feeds whose rows all reached ESDR (or already had), and feeds
+			# queued in the outbox.
+			uploaded_feeds = set()
+			queued_feeds = set()
+			for feed, uploads, raw_batch in batches.itervalues():
+				esdr_data = self.uploader.mergeEsdrUploads(uploads)
+				# Skip samples an earlier run already sent.
+				esdr_data, suppressed_rows, suppressed_values = upload_history.filter(feed['id'], esdr_data, self.SUPPRESS_UNCHANGED)
+				queued = False
+				if not esdr_data['data']:
+					uploaded_feeds.add(feed['id'])
+				else:
+					try:
+						if self.upload(feed, esdr_data):
+							uploaded_feeds.add(feed['id'])
+					except Exception as e:
+						logging.error('Upload to %s (%s) failed: %s' % (feed['id'], feed['name'], e))
+						# Keep going with the other feeds; /outbox/drain replays this one later.
+						if not is_permanent_failure(e):
+							queued = outbox.put(feed, esdr_data)
+							if queued:
+								queued_feeds.add(feed['id'])
+				response.append(OrderedDict([
+					('feed', '%s (%s)' % (feed['name'], feed['id'])),
+					('esdr_data', esdr_data),
+					('suppressed', {'rows': suppressed_rows, 'values': suppressed_values}),
+					('queued', queued),
+					('raw_data', raw_batch)
+				]))
+			upload_history.save()
+			self.after_upload(uploaded_feeds, queued_feeds)
+			report = self.report()
+			if scrape_error:
+				report = OrderedDict([('error', scrape_error)] + report.items())
+			if report:
+				response = OrderedDict([('feeds', response)] + report.items())
 			self.response.write(json.dumps(response))
 		except Exception as e:
 			logging.error(e, exc_info=True)
 			self.response.write(json.dumps({'error': str(e)}))
 
 	def initialize_connector(self):
-		setattr(self, 'esdr', Esdr('awba_auth/auth.json'))
-		product = self.esdr.get_or_create_product(self.PRODUCT_NAME)
+		# Leave a few seconds to write the response.
+		deadline = self.started + self.REQUEST_DEADLINE - 5
+		setattr(self, 'esdr', Esdr('awba_auth/auth.json', pool_size=self.ESDR_POOL_SIZE, deadline=deadline))
+		product = product_cache.get(self.PRODUCT_NAME)
+		if not product:
+			product = self.esdr.get_or_create_product(self.PRODUCT_NAME)
+			product_cache.set(self.PRODUCT_NAME, product)
 		setattr(self, 'uploader', self.UPLOADER(self.esdr, product))
 
 	def scrape(self):
 		raise NotImplementedError()
 
-	@fuzzy_wait(3)
+	def after_upload(self, uploaded_feeds, queued_feeds):
+		# Called once every batch is uploaded or given up on, with the ids of
+		# the feeds whose rows all reached ESDR (or already had) and of those
+		# queued in the outbox.  Connectors that remember what they fetched or
+		# sent move it forward here, so rows are never marked done before a
+		# failure can still lose them.
+		pass
+
+	def report(self):
+		# Connector state to show next to the uploaded feeds in the response.
+		return {}
+
 	def upload(self, feed, data):
+		# Returns whether the data was uploaded (rather than skipped).
 		logging.info('Uploading to %s (%s)' % (feed['id'], feed['name']))
-		if os.getenv('SERVER_SOFTWARE', '').startswith('Google App Engine/') and self.request.headers.get('X-AppEngine-Cron'):
+		if is_production_cron(self.request):
 		  # Production and App Engine cron job:
-		  self.esdr.upload(feed, data)
+		  try:
+		    self.esdr.upload(feed, data)
+		  except requests.HTTPError as e:
+		    if e.response is None or e.response.status_code not in (403, 404):
+		      raise
+		    # The feed was deleted or we lost access to it; resolve it again and
+		    # retry once rather than drop the rows as a permanent failure.
+		    logging.warning('Upload to %s (%s) refused, resolving the feed again: %s' % (feed['id'], feed['name'], e))
+		    refreshed = self.uploader.refreshFeed(feed)
+		    if refreshed is None:
+		      raise e
+		    feed = refreshed
+		    self.esdr.upload(feed, data)
+		  upload_history.record(feed['id'], data)
 		  logging.info('Uploaded to %s (%s)' % (feed['id'], feed['name']))
+		  return True
 		else:
-		  logging.info('... Skipped upload in dev mode.')
\ No newline at end of file
+		  logging.info('... Skipped upload in dev mode.')
+		  return False
\ No newline at end of file
@@ -1,5 +1,8 @@
-import json, os, random, re, requests, unicodedata, urllib, sys, time
+import json, os, random, re, requests, threading, unicodedata, urllib, sys, time
 import logging
+
+from ratelimit import throttle
+from retry import CircuitBreaker, RetryPolicy
 from requests_toolbelt.adapters import appengine
 
 appengine.monkeypatch()
@@ -17,12 +20,136 @@ appengine.monkeypatch()
 #    "password" : <actual password>
 # }
 
+# Keep-alive sessions are shared by every Esdr client in the process, keyed by
+# (prefix, pool_size), so consecutive connector runs on the same instance reuse
+# already-open connections instead of paying a TCP+TLS handshake per call.
+#
+# On App Engine the monkeypatch above makes HTTPAdapter the toolbelt's
+# AppEngineAdapter, which ignores pool_maxsize and sends every call through
+# urlfetch, so there pool_size does nothing and connection reuse is up to
+# urlfetch.  The pooling only takes effect where requests uses real sockets
+# (scripts, tests and benchmarks that skip the monkeypatch).
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(prefix, pool_size):
+    key = (prefix, pool_size)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount(prefix, adapter)
+            _sessions[key] = session
+        return session
+
+# Refresh the access token this many seconds before ESDR says it expires.
+TOKEN_REFRESH_MARGIN = 5 * 60
+
+class TokenCache(object):
+    # OAuth tokens for one (prefix, auth_file) pair, shared by every Esdr
+    # client in the process.  `lock` is held while a token fetch is in flight.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.auth = None
+        self.tokens = None
+        self.expires_at = None
+
+    def set(self, tokens):
+        self.tokens = tokens
+        expires_in = tokens.get('expires_in')
+        self.expires_at = time.time() + expires_in if expires_in else None
+
+    def invalidate(self):
+        self.tokens = None
+        self.expires_at = None
+
+    def is_valid(self, margin=0):
+        if not self.tokens:
+            return False
+        return self.expires_at is None or time.time() < self.expires_at - margin
+
+_token_caches = {}
+_token_caches_lock = threading.Lock()
+
+# One breaker per ESDR server, shared by every client in the process, so a
+# down ESDR costs one timeout per minute instead of one per call.
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(prefix):
+    with _breakers_lock:
+        return _breakers.setdefault(prefix, CircuitBreaker('ESDR (%s)' % prefix))
+
+def get_token_cache(prefix, auth_file):
+    key = (prefix, os.path.abspath(auth_file))
+    with _token_caches_lock:
+        return _token_caches.setdefault(key, TokenCache())
+
+class ProductIndex(object):
+    # Every device and feed of one product, loaded by Esdr.get_product_index
+    # with a few paged queries instead of a lookup per device.
+    def __init__(self, product, devices=(), feeds=()):
+        self.product = product
+        self.devices_by_serial = {}
+        self.feeds_by_device = {}
+        self.feeds_by_location = {}
+        for device in devices:
+            self.add_device(device)
+        for feed in feeds:
+            self.add_feed(feed)
+
+    def add_device(self, device):
+        self.devices_by_serial[device['serialNumber']] = device
+
+    def add_feed(self, feed):
+        self.feeds_by_device.setdefault(feed['deviceId'], []).append(feed)
+        self.feeds_by_location.setdefault((feed['deviceId'], feed['latitude'], feed['longitude']), feed)
+
+    def remove_feed(self, feed_id):
+        # Forget a feed ESDR refused, and its device, so both are looked up
+        # again rather than served from the index.
+        for device_id, feeds in self.feeds_by_device.items():
+            removed = [feed for feed in feeds if feed['id'] == feed_id]
+            if not removed:
+                continue
+            self.feeds_by_device[device_id] = [feed for feed in feeds if feed['id'] != feed_id]
+            for feed in removed:
+                key = (device_id, feed['latitude'], feed['longitude'])
+                if self.feeds_by_location.get(key) is feed:
+                    del self.feeds_by_location[key]
+            for serial_number, device in self.devices_by_serial.items():
+                if device['id'] == device_id:
+                    del self.devices_by_serial[serial_number]
+
+    def get_device_by_serial_number(self, serial_number):
+        return self.devices_by_serial.get(serial_number)
+
+    # Same semantics as Esdr.get_feed.
+    def get_feed(self, device, lat=None, lon=None):
+        if lat and lon:
+            return self.feeds_by_location.get((device['id'], lat, lon))
+        feeds = self.feeds_by_device.get(device['id'])
+        return feeds[0] if feeds else None
+
 class Esdr:
-    def __init__(self, auth_file, prefix='https://esdr.cmucreatelab.org', user_agent='esdr-library.py'):
+    # Don't start an attempt with less than this many seconds left before the deadline.
+    MIN_ATTEMPT_TIME = 2
+
+    # deadline, if set, is the time.time() by which every call must be done;
+    # timeouts and retries are cut to fit the time remaining.
+    def __init__(self, auth_file, prefix='https://esdr.cmucreatelab.org', user_agent='esdr-library.py', pool_size=10,
+                 retry_policy=None, deadline=None, timeout=4 * 60):
         self.prefix = prefix
         self.auth_file = auth_file
         self.tokens = None
         self.user_agent = user_agent
+        self.session = get_session(prefix, pool_size)
+        self.token_cache = get_token_cache(prefix, auth_file)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker = get_circuit_breaker(prefix)
+        self.deadline = deadline
+        self.timeout = timeout
 
     @staticmethod
     def save_client(destination, display_name, username='EDIT ME', password='EDIT ME'):
@@ -65,12 +192,16 @@ class Esdr:
                       if unicodedata.category(c) != 'Mn')
          return re.sub(r'\W+', '_', name).strip('_')
 
+    def remaining_time(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
     def api(self, http_type, path, json_data=None, oauth=True):
         kwargs = {
             'headers': {
                 'User-Agent': self.user_agent
-            },
-            'timeout': 4 * 60
+            }
         }
         
         if json_data:
@@ -85,48 +216,111 @@ class Esdr:
             kwargs['headers']['Authorization'] = 'Bearer %s' % self.get_access_token()
 
         url = self.prefix + path
+        policy = self.retry_policy
 
-        fn = {'GET':requests.get, 'POST':requests.post, 'PUT':requests.put}[http_type]
-        
-        maxRetries = 5
-        for attempt in range(1, maxRetries+1):
+        for attempt in range(1, policy.max_attempts + 1):
+            self.breaker.before_call()
+            remaining = self.remaining_time()
+            kwargs['timeout'] = self.timeout if remaining is None else max(self.MIN_ATTEMPT_TIME, min(self.timeout, remaining))
+            r = None
             try:
-                r = fn(url, **kwargs)
-                if attempt > 1:
-                    logging.info('ESDR.api: Attempt %d succeeded' % attempt)
-                break
-            except (requests.Timeout, requests.ConnectionError, requests.HTTPError):
-                logging.info('ESDR.api: Timeout during attempt %d.' % attempt)
-                if attempt == maxRetries:
-                    logging.info('ESDR.api: No more retries, raising exception')
-                    raise
-                else:
-                    logging.info('ESDR.api: Retrying.')
-                # Sleep with some fuzzing.
-                time.sleep(2 - random.random());
+                throttle(url)
+                r = self.session.request(http_type, url, **kwargs)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                logging.info('ESDR.api: %s during attempt %d.' % (type(e).__name__, attempt))
+                error = e
+            except BaseException:
+                # Any other error (ChunkedEncodingError, DeadlineExceededError,
+                # ...) is not retried, but still ends the attempt, so a
+                # half-open probe can't stay in flight for good.
+                self.breaker.record_failure()
+                raise
+            else:
+                if not policy.should_retry(r):
+                    self.breaker.record_success()
+                    if attempt > 1:
+                        logging.info('ESDR.api: Attempt %d succeeded' % attempt)
+                    break
+                logging.info('ESDR.api: HTTP %d during attempt %d.' % (r.status_code, attempt))
+                error = None
+            self.breaker.record_failure()
+
+            delay = policy.delay(attempt, r)
+            remaining = self.remaining_time()
+            if attempt < policy.max_attempts and (remaining is None or delay + self.MIN_ATTEMPT_TIME <= remaining):
+                logging.info('ESDR.api: Retrying in %.1fs.' % delay)
+                time.sleep(delay)
+                continue
+            logging.info('ESDR.api: No more retries, raising exception')
+            if error is not None:
+                raise error
+            break
         
+        if oauth and r.status_code == 401:
+            # Token was revoked or expired early; fetch a new one on the next call.
+            self.token_cache.invalidate()
         r.raise_for_status()
         return r.json()
 
     def get_access_token(self):
-        if not self.tokens:
-            self.get_tokens()
+        cache = self.token_cache
+        if not cache.is_valid(TOKEN_REFRESH_MARGIN):
+            # While the current token is still usable, let whichever thread is
+            # already refreshing finish rather than queueing up behind it.
+            if cache.lock.acquire(not cache.is_valid()):
+                try:
+                    if not cache.is_valid(TOKEN_REFRESH_MARGIN):
+                        self.get_tokens()
+                finally:
+                    cache.lock.release()
+        self.tokens = cache.tokens
         return self.tokens['access_token']
     
+    def get_auth(self):
+        cache = self.token_cache
+        if cache.auth is None:
+            try:
+                cache.auth = json.load(open(self.auth_file))
+            except Exception as e:
+                raise Exception('While trying to read authorization file %s, %s' % (self.auth_file, e), sys.exc_info()[2])
+        return cache.auth
+
+    # Callers must hold self.token_cache.lock.
     def get_tokens(self):
-        try:
-            auth = json.load(open(self.auth_file))
-        except Exception as e:
-            raise Exception('While trying to read authorization file %s, %s' % (self.auth_file, e), sys.exc_info()[2])
-        self.tokens = self.api('POST',
-                               '/oauth/token',
-                               json.load(open(self.auth_file)),
-                               oauth=False)
+        cache = self.token_cache
+        auth = self.get_auth()
+        tokens = None
+        if cache.tokens and cache.tokens.get('refresh_token'):
+            try:
+                tokens = self.api('POST',
+                                  '/oauth/token',
+                                  {
+                                      'grant_type': 'refresh_token',
+                                      'client_id': auth['client_id'],
+                                      'client_secret': auth['client_secret'],
+                                      'refresh_token': cache.tokens['refresh_token']
+                                  },
+                                  oauth=False)
+            except Exception as e:
+                logging.warning('ESDR: Token refresh failed, falling back to password grant: %s' % e)
+        if tokens is None:
+            tokens = self.api('POST', '/oauth/token', auth, oauth=False)
+        cache.set(tokens)
+        self.tokens = tokens
 
     def query(self, path, args):
         response = self.api('GET', path, args)
         return response['data']['rows']
     
+    def query_all(self, path, args, page_size=1000):
+        rows = []
+        while True:
+            page = dict(args, limit=page_size, offset=len(rows))
+            data = self.api('GET', path, page)['data']
+            rows += data['rows']
+            if not data['rows'] or len(rows) >= data['totalCount']:
+                return rows
+
     def query_first(self, path, args):
         rows = self.query(path, args)
         if len(rows) == 0:
@@ -177,6 +371,13 @@ class Esdr:
         else:
             raise Exception('get_device_by_serial_number: found more than one device?')
         
+    def get_product_index(self, product):
+        where = 'productId=%d' % product['id']
+        devices = self.query_all('/api/v1/devices', {'where': where, 'orderBy': 'id'})
+        feeds = self.query_all('/api/v1/feeds', {'where': where, 'orderBy': 'id'})
+        logging.info('Indexed %d devices and %d feeds of product %s' % (len(devices), len(feeds), product['name']))
+        return ProductIndex(product, devices, feeds)
+
     def create_device(self, product, serial_number, name=None):
         if name == None:
             name = serial_number
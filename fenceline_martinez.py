@@ -1,10 +1,11 @@
-import json, logging, requests, re, os, pytz
+import json, logging, requests, re, os, time
 
 from collections import namedtuple, deque
-from datetime import datetime, timedelta
+from datetime import timedelta
 from requests_toolbelt.adapters import appengine
 from bs4 import BeautifulSoup
 
+from ratelimit import throttle
 from uploader import Uploader
 
 Feed = namedtuple('Feed', ['id', 'name', 'lat', 'lon'])
@@ -92,9 +93,9 @@ class FencelineMartinezUploader(Uploader):
 		}
 
 	def get_now(self):
-		timezone = pytz.timezone('America/Los_Angeles')
-		aware = datetime.now(tz=timezone)
-		return (aware - datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+		# The current time in Los Angeles minus the epoch is just the
+		# current epoch time.
+		return time.time()
 
 	def get_request_headers(self):
 		return {
@@ -166,6 +167,7 @@ class FencelineMartinezUploader(Uploader):
 				yield site, chemical, value
 
 	def fetch_current_data(self):
+		throttle(self.get_request_url())
 		html = requests.get(
 					self.get_request_url(),
 					headers=self.get_request_headers()).content
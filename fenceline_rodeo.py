@@ -1,14 +1,16 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-import json, logging, requests, re, os, pytz
+import json, logging, requests, re, os
 
 from collections import namedtuple, deque
-from datetime import datetime, timedelta
+from datetime import timedelta
 from bs4 import BeautifulSoup
 
 from requests_toolbelt.adapters import appengine
 appengine.monkeypatch()
 
+from ratelimit import throttle
+from timeutil import local_to_epoch
 from uploader import Uploader
 
 Feed = namedtuple('Feed', ['id', 'name', 'lat', 'lon'])
@@ -98,14 +100,12 @@ def parse_data_from_row(raw):
 def make_time(date, time):
 	# Example date: 2020_05_17
 	# Example time: 15:14:23
-	date_time_obj = datetime.strptime('{} {}'.format(date, time), '%Y_%m_%d %H:%M:%S')
-	timezone = pytz.timezone('America/Los_Angeles')
-	aware = timezone.localize(date_time_obj)
-	return (aware - datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+	return local_to_epoch('{} {}'.format(date, time), 'America/Los_Angeles')
 
 
 class FencelineRodeoUploader(Uploader):
 	def fetch_current_data(self):
+		throttle(get_request_url())
 		html = requests.get(
 					get_request_url(),
 					headers=get_request_headers()).content
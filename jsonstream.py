@@ -0,0 +1,55 @@
+import re
+
+# A complete JSON string, a lone quote (a string cut off at the end of the
+# buffer) or a bracket.  Matching whole strings at once keeps brackets inside
+# string values from being counted, and keeps the scan in C for most bytes.
+TOKEN_PATTERN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|"|[{}\[\]]')
+
+def iter_array_items(chunks, key):
+    # Yield the raw JSON text of each element of the array stored under `key`
+    # in the top-level object streamed in `chunks` (unicode strings), without
+    # ever holding more than one element plus one chunk in memory.  Callers
+    # can filter on the raw text before paying for json.loads.
+    quoted_key = '"%s"' % key
+    buf = ''
+    pos = 0
+    depth = 0
+    in_array = False
+    key_seen = False
+    start = None
+    for chunk in chunks:
+        buf += chunk
+        while True:
+            match = TOKEN_PATTERN.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            token = match.group()
+            if token == '"':
+                # Unterminated string: wait for the next chunk.
+                pos = match.start()
+                break
+            pos = match.end()
+            if token[0] == '"':
+                key_seen = depth == 1 and token == quoted_key
+                continue
+            if token in '{[':
+                depth += 1
+                if depth == 2 and token == '[' and key_seen:
+                    in_array = True
+                elif depth == 3 and in_array:
+                    start = match.start()
+            else:
+                depth -= 1
+                if depth == 2 and in_array and start is not None:
+                    yield buf[start:pos]
+                    start = None
+                elif depth == 1 and in_array:
+                    return
+            key_seen = False
+        # Drop everything before the element being read.
+        keep = start if start is not None else pos
+        buf = buf[keep:]
+        pos -= keep
+        if start is not None:
+            start = 0
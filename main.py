@@ -11,84 +11,301 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import webapp2
+import calendar, hashlib, json, logging, time, webapp2
 
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
+from backfill import Backfill, split_range
 from chevron import ChevronUploader
-from connector import Connector
+from connector import Connector, is_production, is_production_cron
+from esdr import Esdr
 from fenceline_martinez import FencelineMartinezUploader
 from fenceline_rodeo import FencelineRodeoUploader
-from purpleair import PurpleAirUploader
+from outbox import outbox
+from pipeline import parallel_map
+from purpleair import BAY_AREA_BOUNDS, PURPLE_AIR_SENSORS, THINGSPEAK_WINDOW, PurpleAirUploader, poll_scheduler
+from sharding import get_shard, sensor_costs
+from sonomatech import QcCodeHistory, QcCodeUploads
 from valero import ValeroUploader
+from wind import WindAggregator, WindUploads
 
 class PurpleAirConnector(Connector):
 	UPLOADER = PurpleAirUploader
 	PRODUCT_NAME = 'AWBA_PurpleAir'
 	BAY_AREA_PURPLE_AIR = set()
+	# Sensors asked for in one PurpleAir request.
+	MAX_IDS_PER_REQUEST = 20
+	# Requests (and device parses and feed resolutions) run at once.
+	CONCURRENCY = 8
+
+	def sensors(self):
+		return self.BAY_AREA_PURPLE_AIR
+
+	def fetch_devices(self, device_ids):
+		started = time.time()
+		try:
+			devices_by_id = self.uploader.get_purple_air_devices(device_ids, self.MAX_IDS_PER_REQUEST)
+			# Each sensor's share of the request, for SensorCosts.
+			for device_id in device_ids:
+				self.fetch_costs[device_id] = (time.time() - started) / len(device_ids)
+			return device_ids, devices_by_id
+		except Exception as e:
+			# One failed batch shouldn't cost the rest of the run.
+			logging.warning('PurpleAir devices %s failed: %s' % (device_ids, e))
+			return device_ids, None
+
+	def parse_sensor(self, sensor):
+		# sensor is (device_id, [results]) for a sensor and its child channels.
+		device_id, devices = sensor
+		started = time.time()
+		feed_data = []
+		failed = False
+		for device in devices:
+			try:
+				data = self.uploader.parse_device(device)
+			except Exception as e:
+				logging.warning('PurpleAir device %s failed: %s' % (device.get('ID'), e))
+				failed = True
+				continue
+			if data:
+				feed_data.append(data)
+		if feed_data:
+			poll_scheduler.record(device_id, max(data['time'] for _, _, data in feed_data))
+		elif devices and not failed:
+			# Only a sensor whose location or time doesn't parse is negative
+			# cached.  An error such as ESDR failing to resolve its feed, or
+			# PurpleAir leaving the sensor out of a response, says nothing
+			# about the sensor, so its schedule is left alone.
+			poll_scheduler.record(device_id, None)
+		sensor_costs.record(device_id, self.fetch_costs.get(device_id, 0) + time.time() - started)
+		return feed_data
 
 	def scrape(self):
-		bay_area_purple_air_devices = iter(self.uploader.get_purple_air_device(device_id) for device_id in self.BAY_AREA_PURPLE_AIR)
-		for devices in bay_area_purple_air_devices:
-			for device in devices:
-				feed_data = self.uploader.parse_device(device)
-				if feed_data:
-					yield feed_data
-				# Uncomment to upload all data between two dates.
-				# yield self.uploader.upload_thingspeak_data(device, datetime(2019, 5, 1), datetime(2019, 5, 3))
+		# Stale and unparseable sensors are polled less often; see PollScheduler.
+		device_ids = poll_scheduler.due(sorted(self.sensors()))
+		self.fetch_costs = {}
+		chunks = [device_ids[i:i + self.MAX_IDS_PER_REQUEST] for i in range(0, len(device_ids), self.MAX_IDS_PER_REQUEST)]
+		for requested_ids, devices_by_id in parallel_map(self.fetch_devices, chunks, self.CONCURRENCY):
+			if devices_by_id is None:
+				continue
+			sensors = [(device_id, devices_by_id.get(device_id, [])) for device_id in requested_ids]
+			for feed_data in parallel_map(self.parse_sensor, sensors, self.CONCURRENCY):
+				for data in feed_data:
+					yield data
+		sensor_costs.save()
+
+	def report(self):
+		schedule = poll_scheduler.schedule()
+		sensors = self.sensors()
+		return {'schedule': {
+			'sensors': dict((device_id, state) for device_id, state in schedule['sensors'].items() if device_id in sensors),
+			'unparseable': [device_id for device_id in schedule['unparseable'] if device_id in sensors],
+		}}
+
+# Every sensor in the Bay Area, found by streaming PurpleAir's global list.
+class PurpleAirBayAreaConnector(PurpleAirConnector):
+	BOUNDS = BAY_AREA_BOUNDS
+
+	def scrape(self):
+		self.fetch_costs = {}
+		sensors = OrderedDict()
+		for device in self.uploader.get_all_purple_air_devices(bounds=self.BOUNDS):
+			sensors.setdefault(device.get('ParentID') or device['ID'], []).append(device)
+		for feed_data in parallel_map(self.parse_sensor, sensors.items(), self.CONCURRENCY):
+			for data in feed_data:
+				yield data
+
+	def report(self):
+		return {}
 
 # Split up Benicia and Vallejo end points for better parallelism.
 class PurpleAirBeniciaConnector(PurpleAirConnector):
-	BAY_AREA_PURPLE_AIR = {
-		  3765, 3939,
-		  3964, 11988,
-		  11990, 20187,
-		  22451, 23933,
-		  27237, 38503,
-		  39655, 39665,
-		  39667, 39717,
-		  39745, 43787,
-		  45905, 54335,
-		  65217, 69607,
-		  71763, 79147,
-		  92121
-	}
+	BAY_AREA_PURPLE_AIR = PURPLE_AIR_SENSORS['benicia']
 
 class PurpleAirVallejoConnector(PurpleAirConnector):
-	BAY_AREA_PURPLE_AIR = {
-		4491, 38429,
-		6578, 23597,
-		5127, 1870,
-		2480,
-	}
-
-class ValeroConnector(Connector):
+	BAY_AREA_PURPLE_AIR = PURPLE_AIR_SENSORS['vallejo']
+
+class PurpleAirShardConnector(PurpleAirConnector):
+	# GET /purpleair/shard/<k>/<n> polls shard k of n of every registered
+	# sensor.  Shards come from consistent hashing weighted by the sensors'
+	# costs, frozen hourly so every shard agrees (see sharding.get_shard), so
+	# adding sensors or raising n in cron.yaml rebalances them without code
+	# changes.
+	BAY_AREA_PURPLE_AIR = set().union(*PURPLE_AIR_SENSORS.values())
+
+	def get(self, shard, shard_count):
+		shard = int(shard)
+		shard_count = int(shard_count)
+		if shard >= shard_count:
+			self.abort(404)
+		self.shard_sensors = get_shard('purpleair', self.BAY_AREA_PURPLE_AIR, shard, shard_count)
+		return super(PurpleAirShardConnector, self).get()
+
+	def sensors(self):
+		return self.shard_sensors
+
+class PurpleAirBackfillConnector(PurpleAirConnector):
+	# GET /purpleair/backfill?start=YYYY-MM-DD&end=YYYY-MM-DD[&sensors=id,id,...]
+	# loads ThingSpeak history for the given sensors (all polled sensors by
+	# default), one THINGSPEAK_WINDOW per sensor channel at a time.  Repeat the
+	# request until 'complete' is true; finished windows are checkpointed.
+	BAY_AREA_PURPLE_AIR = set().union(*PURPLE_AIR_SENSORS.values())
+	CONCURRENCY = 4
+
+	def get(self):
+		self.started = time.time()
+		self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+		self.initialize_connector()
+		try:
+			start = datetime.strptime(self.request.get('start'), '%Y-%m-%d')
+			end = datetime.strptime(self.request.get('end'), '%Y-%m-%d')
+			sensors = sorted(int(id) for id in self.request.get('sensors').split(',') if id) or sorted(self.BAY_AREA_PURPLE_AIR)
+			devices = {}
+			for i in range(0, len(sensors), self.MAX_IDS_PER_REQUEST):
+				for results in self.uploader.get_purple_air_devices(sensors[i:i + self.MAX_IDS_PER_REQUEST]).values():
+					for device in results:
+						if device.get('THINGSPEAK_PRIMARY_ID'):
+							devices[device['ID']] = device
+			windows = split_range(start, end, THINGSPEAK_WINDOW)
+			tasks = [(device_id, window_start, window_end) for device_id in sorted(devices) for window_start, window_end in windows]
+
+			def fetch(task):
+				device_id, window_start, window_end = task
+				feed_upload = self.uploader.get_thingspeak_upload(devices[device_id], window_start, window_end)
+				return [feed_upload] if feed_upload else []
+
+			job_id = 'purpleair:%s:%s:%s' % (start.date(), end.date(), hashlib.md5(','.join(map(str, sensors))).hexdigest()[:8])
+			backfill = Backfill(job_id, tasks, fetch, self.backfill_upload,
+								key=lambda task: '%s/%s' % (task[0], task[1].isoformat()),
+								concurrency=self.CONCURRENCY, deadline=self.esdr.deadline)
+			self.response.write(json.dumps(backfill.run()))
+		except Exception as e:
+			logging.error(e, exc_info=True)
+			self.response.write(json.dumps({'error': str(e)}))
+
+	def backfill_upload(self, feed, data):
+		logging.info('Uploading %d rows to %s (%s)' % (len(data['data']), feed['id'], feed['name']))
+		if is_production():
+			self.esdr.upload(feed, data)
+		else:
+			logging.info('... Skipped upload in dev mode.')
+
+class SonomaTechConnector(Connector):
+
+	def scrape(self):
+		# The ESDR feeds each stream's rows went to, for the streams parsed
+		# to the end.
+		self.stream_feeds = {}
+		uploader = self.uploader
+		for stream, fetch, parse in ((uploader.DATA_STREAM, uploader.fetch_devices, uploader.parse_devices),
+									 (uploader.WIND_STREAM, uploader.fetch_wind_devices, uploader.parse_wind_devices)):
+			feed_ids = set()
+			for feed_data in parse(fetch()):
+				if feed_data:
+					feed_ids.add(feed_data[0]['id'])
+					yield feed_data
+			self.stream_feeds[stream] = feed_ids
+
+	def after_upload(self, uploaded_feeds, queued_feeds):
+		# A stream's watermarks move past this run's windows only once all
+		# their rows are uploaded or queued; otherwise they're fetched again.
+		delivered = uploaded_feeds | queued_feeds
+		self.uploader.commit_windows([stream for stream, feed_ids in self.stream_feeds.items() if feed_ids <= delivered])
+		# QC code changes count as sent only once uploaded.
+		self.uploader.qc_codes.commit(uploaded_feeds)
+		# Wind windows move past their summaries once those are delivered.
+		self.uploader.wind_summaries.commit(delivered)
+
+	def report(self):
+		if self.uploader.failed_groups:
+			return {'failed_parameter_groups': self.uploader.failed_groups}
+		return {}
+
+class ValeroConnector(SonomaTechConnector):
 	UPLOADER = ValeroUploader
 	PRODUCT_NAME = 'AWBA_Valero'
 
-	def scrape(self):
-		devices = self.uploader.fetch_devices()
-		for feed_data in self.uploader.parse_devices(devices):
-			if feed_data:
-				yield feed_data
-		devices = self.uploader.fetch_wind_devices()
-		for feed_data in self.uploader.parse_wind_devices(devices):
-			if feed_data:
-				yield feed_data
-
-class ChevronConnector(Connector):
+class ChevronConnector(SonomaTechConnector):
 	UPLOADER = ChevronUploader
 	PRODUCT_NAME = 'AWBA_Chevron'
 
-	def scrape(self):
-		devices = self.uploader.fetch_devices()
-		for feed_data in self.uploader.parse_devices(devices):
-			if feed_data:
-				yield feed_data
-		devices = self.uploader.fetch_wind_devices()
-		for feed_data in self.uploader.parse_wind_devices(devices):
-			if feed_data:
-				yield feed_data
+class SonomaTechBackfillConnector(Connector):
+	# GET /<product>/backfill?start=YYYY-MM-DD&end=YYYY-MM-DD[&sites=id,...]
+	# [&parameters=id,...][&wind=0] loads Sonoma Tech history, one
+	# BACKFILL_WINDOW per parameter group (and of wind) at a time, parsed the
+	# same way as the live data.  Repeat the request until 'complete' is true;
+	# finished windows are checkpointed.
+	BACKFILL_WINDOW = timedelta(hours=6)
+	CONCURRENCY = 4
+
+	def get(self):
+		self.started = time.time()
+		self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+		self.initialize_connector()
+		try:
+			start = datetime.strptime(self.request.get('start'), '%Y-%m-%d')
+			end = datetime.strptime(self.request.get('end'), '%Y-%m-%d')
+			sites = sorted(int(id) for id in self.request.get('sites').split(',') if id)
+			# Given sites are looked up in both data and wind requests.
+			wind_sites = [site for site in self.UPLOADER.WIND_SITE_IDS if site in sites] if sites else self.UPLOADER.WIND_SITE_IDS
+			sites = [site for site in sites if site in self.UPLOADER.SITE_IDS] if sites else self.UPLOADER.SITE_IDS
+			if self.request.get('wind') == '0':
+				wind_sites = []
+			parameter_groups = self.UPLOADER.PARAMETER_GROUPS
+			parameters = [int(id) for id in self.request.get('parameters').split(',') if id]
+			if parameters:
+				size = max(len(group) for group in self.UPLOADER.PARAMETER_GROUPS)
+				parameter_groups = [parameters[i:i + size] for i in range(0, len(parameters), size)]
+			windows = split_range(start, end, self.BACKFILL_WINDOW)
+			# (comma-separated parameters or 'wind', window start, window end)
+			tasks = []
+			# Given sites that are all wind-only (or unknown) leave no data
+			# sites, rather than every one.
+			if sites:
+				tasks += [(','.join(map(str, group)), window_start, window_end) for group in parameter_groups for window_start, window_end in windows]
+			if wind_sites:
+				tasks += [('wind', window_start, window_end) for window_start, window_end in windows]
+
+			def fetch(task):
+				parameters, window_start, window_end = task
+				if parameters == 'wind':
+					devices = self.uploader.request_wind_data(wind_sites, window_start, window_end)
+					# The boundary at window_start belongs to the window before.
+					aggregator = WindUploads(WindAggregator(self.uploader.WIND_WINDOW, self.uploader.WIND_STEP))
+					feed_uploads = [(feed, esdr_data, raw_data) for feed, esdr_data, raw_data in
+									self.uploader.parse_wind_devices(devices, aggregator, flush=True)
+									if esdr_data['data'][0][0] > calendar.timegm(window_start.utctimetuple())]
+				else:
+					devices = self.uploader.request_data(map(int, parameters.split(',')), window_start, window_end, sites)
+					# Each window only suppresses QC codes repeated within it.
+					feed_uploads = self.uploader.parse_devices(devices, QcCodeUploads(QcCodeHistory()))
+				return [(feed, esdr_data) for feed, esdr_data, raw_data in feed_uploads]
+
+			job_id = '%s:%s:%s:%s' % (self.PRODUCT_NAME, start.date(), end.date(),
+									  hashlib.md5(json.dumps([sites, parameter_groups, wind_sites])).hexdigest()[:8])
+			backfill = Backfill(job_id, tasks, fetch, self.backfill_upload,
+								key=lambda task: '%s/%s' % (task[0], task[1].isoformat()),
+								concurrency=self.CONCURRENCY, deadline=self.esdr.deadline)
+			self.response.write(json.dumps(backfill.run()))
+		except Exception as e:
+			logging.error(e, exc_info=True)
+			self.response.write(json.dumps({'error': str(e)}))
+
+	def backfill_upload(self, feed, data):
+		logging.info('Uploading %d rows to %s (%s)' % (len(data['data']), feed['id'], feed['name']))
+		if is_production():
+			self.esdr.upload(feed, data)
+		else:
+			logging.info('... Skipped upload in dev mode.')
+
+class ChevronBackfillConnector(SonomaTechBackfillConnector):
+	UPLOADER = ChevronUploader
+	PRODUCT_NAME = 'AWBA_Chevron'
+
+class ValeroBackfillConnector(SonomaTechBackfillConnector):
+	UPLOADER = ValeroUploader
+	PRODUCT_NAME = 'AWBA_Valero'
 
 class FencelineRodeoConnector(Connector):
 	UPLOADER = FencelineRodeoUploader
@@ -102,18 +319,47 @@ class FencelineRodeoConnector(Connector):
 class FencelineMartinezConnector(Connector):
 	UPLOADER = FencelineMartinezUploader
 	PRODUCT_NAME = 'AWBA_FencelineMartinez'
+	# The page restamps the same table values with the current time every minute.
+	SUPPRESS_UNCHANGED = True
 
 	def scrape(self):
 		for data in self.uploader.fetch_current_data():
 			if data:
 				yield data
 
+class OutboxDrainHandler(webapp2.RequestHandler):
+	# Replays uploads that failed during connector runs, coalesced per feed.
+	# Seconds App Engine gives the request, as for Connector.
+	REQUEST_DEADLINE = 60
+
+	def get(self):
+		started = time.time()
+		self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+		if not is_production_cron(self.request):
+			logging.info('... Skipped outbox drain in dev mode.')
+			self.response.write(json.dumps({'skipped': True}))
+			return
+		try:
+			# Leave a few seconds to write the response.
+			deadline = started + self.REQUEST_DEADLINE - 5
+			esdr = Esdr('awba_auth/auth.json', deadline=deadline)
+			self.response.write(json.dumps(outbox.drain(esdr.upload, deadline)))
+		except Exception as e:
+			logging.error(e, exc_info=True)
+			self.response.write(json.dumps({'error': str(e)}))
+
 app = webapp2.WSGIApplication([
 	('/chevron', ChevronConnector),
+	('/chevron/backfill', ChevronBackfillConnector),
 	('/fenceline/martinez', FencelineMartinezConnector),
 	('/fenceline/rodeo', FencelineRodeoConnector),
+	('/outbox/drain', OutboxDrainHandler),
 	('/purpleair', PurpleAirConnector),
+	('/purpleair/backfill', PurpleAirBackfillConnector),
+	('/purpleair/bayarea', PurpleAirBayAreaConnector),
 	('/purpleair/benicia', PurpleAirBeniciaConnector),
+	(r'/purpleair/shard/(\d+)/(\d+)', PurpleAirShardConnector),
 	('/purpleair/vallejo', PurpleAirVallejoConnector),
 	('/valero', ValeroConnector),
+	('/valero/backfill', ValeroBackfillConnector),
 ], debug=True)
\ No newline at end of file
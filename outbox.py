@@ -0,0 +1,246 @@
+import json, logging, os, requests, threading, time
+
+from collections import OrderedDict
+
+from cache import cache_path
+from uploader import merge_esdr_uploads, split_esdr_upload
+
+try:
+    from google.appengine.ext import ndb
+except ImportError:
+    # Outside App Engine (tests, scripts); the outbox uses a file or memory.
+    ndb = None
+
+# Replayed payloads are split into PUTs of at most this many rows.
+MAX_ROWS_PER_UPLOAD = 5000
+
+# Rows per Datastore entity, to stay well under its 1 MB limit.
+MAX_ROWS_PER_ENTITY = 1000
+
+# Datastore entities a drain takes at once; the rest wait for the next drain.
+MAX_ENTITIES_PER_DRAIN = 500
+
+# Datastore entities the outbox keeps; queueing past it drops the oldest.
+MAX_ENTITIES = 2000
+
+def is_permanent_failure(e):
+    # A 4xx other than 429 won't succeed on replay (deleted feed, bad payload).
+    response = getattr(e, 'response', None)
+    return (isinstance(e, requests.HTTPError) and response is not None and
+            400 <= response.status_code < 500 and response.status_code != 429)
+
+class MemoryStore(object):
+    # Entries in a list, lost with the instance.
+    def __init__(self):
+        self.entries = []
+
+    def append(self, entry):
+        self.entries.append(entry)
+        return len(json.dumps(self.entries))
+
+    def pending(self):
+        return self.entries
+
+    def replace(self, entries):
+        self.entries = entries
+
+    def take(self):
+        entries, self.entries = self.entries, []
+        return entries, None
+
+    def finish(self, taken, failed):
+        self.entries = failed + self.entries
+
+class FileStore(object):
+    # Entries appended as JSON lines to `path`.  A drain moves them aside to
+    # `path + '.draining'` before uploading, so uploads queued meanwhile
+    # aren't lost; if the drain is killed the next one re-sends that file,
+    # which is harmless as ESDR uploads are idempotent.
+    def __init__(self, path):
+        self.path = path
+        self.draining_path = path + '.draining'
+
+    def read(self, path):
+        if not os.path.exists(path):
+            return []
+        entries = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Torn final line from a killed request.
+                    logging.warning('Outbox: skipping unreadable entry in %s' % path)
+        return entries
+
+    def write(self, path, entries):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+        os.rename(tmp_path, path)
+
+    def append(self, entry):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        return os.path.getsize(self.path)
+
+    def pending(self):
+        return self.read(self.path)
+
+    def replace(self, entries):
+        self.write(self.path, entries)
+
+    def take(self):
+        entries = self.read(self.draining_path) + self.read(self.path)
+        self.write(self.draining_path, entries)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        return entries, None
+
+    def finish(self, taken, failed):
+        if failed:
+            self.write(self.path, failed + self.read(self.path))
+        if os.path.exists(self.draining_path):
+            os.remove(self.draining_path)
+
+if ndb is not None:
+    class OutboxEntry(ndb.Model):
+        # Up to MAX_ROWS_PER_ENTITY rows of one failed upload.
+        feed = ndb.JsonProperty(indexed=False)
+        data = ndb.JsonProperty(compressed=True)
+        created = ndb.DateTimeProperty(auto_now_add=True)
+
+class DatastoreStore(object):
+    # Entries as OutboxEntry entities, shared by every instance and kept
+    # across restarts, so the drain cron replays the failures of whichever
+    # instance had them.  Entities are deleted once replayed; two drains
+    # running at once may both send an entry, which is harmless.  Past
+    # max_entities the oldest are dropped as new ones are queued.
+    def __init__(self, max_entities=MAX_ENTITIES):
+        self.max_entities = max_entities
+
+    def append(self, entry):
+        entities = [OutboxEntry(feed=entry['feed'], data=data)
+                    for data in split_esdr_upload(entry['data'], MAX_ROWS_PER_ENTITY)]
+        ndb.put_multi(entities)
+        # Keys-only, so counting costs no entity reads.
+        excess = OutboxEntry.query().count(limit=self.max_entities + len(entities)) - self.max_entities
+        if excess > 0:
+            ndb.delete_multi(OutboxEntry.query().order(OutboxEntry.created).fetch(excess, keys_only=True))
+            logging.warning('Outbox: over %d entities, dropped the %d oldest' % (self.max_entities, excess))
+        # The store bounds itself; put has nothing to compact.
+        return None
+
+    def take(self):
+        entities = OutboxEntry.query().order(OutboxEntry.created).fetch(MAX_ENTITIES_PER_DRAIN)
+        return [{'feed': entity.feed, 'data': entity.data} for entity in entities], [entity.key for entity in entities]
+
+    def finish(self, taken, failed):
+        for entry in failed:
+            self.append(entry)
+        ndb.delete_multi(taken)
+
+class Outbox(object):
+    # ESDR uploads that failed, kept in `store` until a drain replays them.
+    # Entries are compacted to one merged payload per feed when drained, and
+    # by put() once a file or memory store exceeds max_bytes.
+    def __init__(self, store, max_bytes=20 * 1024 * 1024):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def compact(self, entries):
+        batches = OrderedDict()
+        for entry in entries:
+            feed, uploads = batches.setdefault(entry['feed']['id'], (entry['feed'], []))
+            uploads.append(entry['data'])
+        return [{'feed': feed, 'data': merge_esdr_uploads(uploads)} for feed, uploads in batches.values()]
+
+    def trim(self, entries):
+        # Drop the oldest rows until the compacted entries fit in max_bytes.
+        size = sum(len(json.dumps(entry)) + 1 for entry in entries)
+        dropped = 0
+        while size > self.max_bytes and entries:
+            entry = max(entries, key=lambda entry: len(entry['data']['data']))
+            count = max(1, len(entry['data']['data']) // 10)
+            entry['data']['data'] = entry['data']['data'][count:]
+            dropped += count
+            entries = [entry for entry in entries if entry['data']['data']]
+            size = sum(len(json.dumps(entry)) + 1 for entry in entries)
+        if dropped:
+            logging.warning('Outbox: over %d bytes, dropped %d oldest rows' % (self.max_bytes, dropped))
+        return entries
+
+    def put(self, feed, esdr_data):
+        # Returns whether the payload was queued.  put runs while handling a
+        # failed upload, so its own failures are logged rather than raised.
+        entry = {'feed': {'id': feed['id'], 'name': feed['name']}, 'data': esdr_data}
+        try:
+            with self.lock:
+                size = self.store.append(entry)
+                if size is not None and size > self.max_bytes:
+                    self.store.replace(self.trim(self.compact(self.store.pending())))
+        except Exception as e:
+            logging.error('Outbox: could not queue %d rows for feed %s: %s' % (len(esdr_data['data']), feed['id'], e))
+            return False
+        return True
+
+    def take(self):
+        # Take everything pending for draining, one payload per feed.  Every
+        # store is already bounded when queueing, so nothing is trimmed here;
+        # a Datastore drain takes only a slice of the outbox, and trimming it
+        # would drop rows the budget allows.
+        with self.lock:
+            entries, taken = self.store.take()
+        return self.compact(entries), taken
+
+    def finish(self, taken, failed):
+        # Requeue what could not be replayed and forget what was taken.
+        with self.lock:
+            self.store.finish(taken, self.compact(failed))
+
+    def drain(self, upload, deadline=None):
+        # Replay queued payloads through upload(feed, esdr_data), coalesced per
+        # feed into PUTs of up to MAX_ROWS_PER_UPLOAD rows.  Feeds not started
+        # by `deadline` (a time.time()) stay queued for the next drain.
+        entries, taken = self.take()
+        failed = []
+        result = {'feeds': 0, 'rows': 0, 'failed_feeds': 0, 'dropped_feeds': 0, 'deferred_feeds': 0}
+        for entry in entries:
+            feed, esdr_data = entry['feed'], entry['data']
+            if deadline is not None and time.time() >= deadline:
+                failed.append(entry)
+                result['deferred_feeds'] += 1
+                continue
+            try:
+                sent = 0
+                for chunk in split_esdr_upload(esdr_data, MAX_ROWS_PER_UPLOAD):
+                    upload(feed, chunk)
+                    sent += len(chunk['data'])
+                result['feeds'] += 1
+                result['rows'] += sent
+            except Exception as e:
+                if is_permanent_failure(e):
+                    logging.error('Outbox: dropping %d rows for feed %s: %s' % (len(esdr_data['data']), feed['id'], e))
+                    result['dropped_feeds'] += 1
+                else:
+                    logging.warning('Outbox: replay to feed %s failed, keeping it queued: %s' % (feed['id'], e))
+                    # Keep only the rows that didn't make it.
+                    failed.append({'feed': feed, 'data': {'channel_names': esdr_data['channel_names'],
+                                                          'data': esdr_data['data'][sent:]}})
+                    result['failed_feeds'] += 1
+        self.finish(taken, failed)
+        return result
+
+def get_store():
+    # App Engine's sandbox has no writable disk, so there the outbox lives in
+    # Datastore; elsewhere under AWBA_CACHE_DIR, or in memory.
+    if ndb is not None:
+        return DatastoreStore()
+    path = cache_path('outbox.jsonl')
+    if path:
+        return FileStore(path)
+    return MemoryStore()
+
+outbox = Outbox(get_store())
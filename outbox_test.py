@@ -0,0 +1,105 @@
+import requests
+
+from outbox import FileStore, MemoryStore, Outbox
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def http_error(status_code):
+    e = requests.HTTPError('%d' % status_code)
+    e.response = FakeResponse(status_code)
+    return e
+
+
+def test_compact_merges_entries_per_feed():
+    outbox = Outbox(MemoryStore())
+    entries = outbox.compact([
+        {'feed': {'id': 1, 'name': 'a'}, 'data': {'channel_names': ['x'], 'data': [[20, 2]]}},
+        {'feed': {'id': 2, 'name': 'b'}, 'data': {'channel_names': ['x'], 'data': [[10, 5]]}},
+        {'feed': {'id': 1, 'name': 'a'}, 'data': {'channel_names': ['y'], 'data': [[10, 1], [20, 3]]}},
+    ])
+
+    assert entries == [
+        {'feed': {'id': 1, 'name': 'a'}, 'data': {'channel_names': ['x', 'y'], 'data': [[10, None, 1], [20, 2, 3]]}},
+        {'feed': {'id': 2, 'name': 'b'}, 'data': {'channel_names': ['x'], 'data': [[10, 5]]}},
+    ]
+
+
+def test_trim_drops_the_oldest_rows_of_the_biggest_feed():
+    outbox = Outbox(MemoryStore(), max_bytes=400)
+    entries = outbox.trim([
+        {'feed': {'id': 1, 'name': 'a'}, 'data': {'channel_names': ['x'], 'data': [[t, 1] for t in range(100)]}},
+        {'feed': {'id': 2, 'name': 'b'}, 'data': {'channel_names': ['x'], 'data': [[0, 1]]}},
+    ])
+
+    rows = entries[0]['data']['data']
+    assert sum(len(str(entry)) for entry in entries) < 1000
+    assert rows[-1] == [99, 1] and rows[0][0] > 0
+    assert entries[1]['data']['data'] == [[0, 1]]
+
+
+def drain_twice(outbox):
+    uploads = []
+
+    def upload(feed, esdr_data):
+        if feed['id'] == 2:
+            raise http_error(503)
+        if feed['id'] == 3:
+            raise http_error(400)
+        uploads.append((feed['id'], esdr_data['data']))
+
+    outbox.put({'id': 1, 'name': 'a'}, {'channel_names': ['x'], 'data': [[10, 1]]})
+    outbox.put({'id': 2, 'name': 'b'}, {'channel_names': ['x'], 'data': [[10, 2]]})
+    outbox.put({'id': 3, 'name': 'c'}, {'channel_names': ['x'], 'data': [[10, 3]]})
+    outbox.put({'id': 1, 'name': 'a'}, {'channel_names': ['x'], 'data': [[20, 4]]})
+
+    result = outbox.drain(upload)
+    assert result == {'feeds': 1, 'rows': 2, 'failed_feeds': 1, 'dropped_feeds': 1, 'deferred_feeds': 0}
+    assert uploads == [(1, [[10, 1], [20, 4]])]
+
+    # The transient failure stays queued, the permanent one is gone.
+    result = outbox.drain(upload)
+    assert result == {'feeds': 0, 'rows': 0, 'failed_feeds': 1, 'dropped_feeds': 0, 'deferred_feeds': 0}
+
+
+def test_drain_from_memory():
+    drain_twice(Outbox(MemoryStore()))
+
+
+def test_drain_from_file(tmpdir):
+    path = str(tmpdir.join('outbox.jsonl'))
+    drain_twice(Outbox(FileStore(path)))
+    assert not tmpdir.join('outbox.jsonl.draining').check()
+
+
+def test_drain_keeps_feeds_queued_past_the_deadline():
+    outbox = Outbox(MemoryStore())
+    outbox.put({'id': 1, 'name': 'a'}, {'channel_names': ['x'], 'data': [[10, 1]]})
+
+    result = outbox.drain(lambda feed, esdr_data: None, deadline=0)
+    assert result['deferred_feeds'] == 1
+    assert outbox.drain(lambda feed, esdr_data: None)['feeds'] == 1
+
+
+def test_put_compacts_a_full_file(tmpdir):
+    store = FileStore(str(tmpdir.join('outbox.jsonl')))
+    outbox = Outbox(store, max_bytes=200)
+    for t in range(20):
+        outbox.put({'id': 1, 'name': 'a'}, {'channel_names': ['x'], 'data': [[t, t]]})
+
+    # One merged entry holding the newest rows.
+    entries = store.pending()
+    assert len(entries) == 1
+    rows = entries[0]['data']['data']
+    assert rows == [[t, t] for t in range(20 - len(rows), 20)]
+
+
+def test_put_failure_is_not_raised():
+    class BrokenStore(MemoryStore):
+        def append(self, entry):
+            raise IOError('read-only file system')
+
+    assert not Outbox(BrokenStore()).put({'id': 1, 'name': 'a'}, {'channel_names': ['x'], 'data': [[10, 1]]})
@@ -0,0 +1,45 @@
+import logging, threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+def parallel_map(func, items, concurrency=8):
+    # Like map(), but runs func on up to `concurrency` items at a time in
+    # worker threads and yields results as they finish, so callers can keep
+    # consuming a generator while slower items are still in flight.  An
+    # exception raised by func is re-raised to the consumer.
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    tasks = queue.Queue()
+    for item in items:
+        tasks.put(item)
+    results = queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                item = tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results.put((True, func(item)))
+            except Exception as e:
+                logging.error('parallel_map: %r failed' % (item,), exc_info=True)
+                results.put((False, e))
+
+    for _ in range(min(concurrency, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    for _ in items:
+        ok, value = results.get()
+        if not ok:
+            raise value
+        yield value
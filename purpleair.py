@@ -1,23 +1,165 @@
-import datetime, json, requests, logging, os
+import codecs, datetime, json, requests, logging, os, re, threading, time
 
+from cache import LRUCache
+from jsonstream import iter_array_items
+from ratelimit import throttle
+from timeutil import parse_utc_column
 from uploader import Uploader
 
 from requests_toolbelt.adapters import appengine
 appengine.monkeypatch()
 
+# Sensors we poll, by area.  /purpleair/shard/<k>/<n> splits all of them.
+PURPLE_AIR_SENSORS = {
+    'benicia': {
+        3765, 3939,
+        3964, 11988,
+        11990, 20187,
+        22451, 23933,
+        27237, 38503,
+        39655, 39665,
+        39667, 39717,
+        39745, 43787,
+        45905, 54335,
+        65217, 69607,
+        71763, 79147,
+        92121
+    },
+    'vallejo': {
+        4491, 38429,
+        6578, 23597,
+        5127, 1870,
+        2480,
+    },
+}
+
+# The JSON API takes several sensor IDs separated by '|'.
+MAX_IDS_PER_REQUEST = 20
+
+# ThingSpeak answers at most 8000 entries per request; a day of the fastest
+# (20 s) PurpleAir samples is 4320.
+THINGSPEAK_WINDOW = datetime.timedelta(days=1)
+
+# (ThingSpeak field name, ESDR channel name)
+THINGSPEAK_FIELDS = [
+    ('PM2.5 (CF=1)', 'PM2_5'),
+    ('RSSI', 'RSSI'),
+    ('Uptime', 'Uptime'),
+    ('Humidity', 'humidity'),
+    ('Temperature', 'temp_f'),
+]
+
+# (south, west, north, east) of the nine Bay Area counties.
+BAY_AREA_BOUNDS = (36.89, -123.63, 38.86, -121.2)
+
+ID_PATTERN = re.compile(r'"(?:Parent)?ID"\s*:\s*([0-9]+)')
+LAT_PATTERN = re.compile(r'"Lat"\s*:\s*(-?[0-9.]+)')
+LON_PATTERN = re.compile(r'"Lon"\s*:\s*(-?[0-9.]+)')
+
+def to_float_column(values):
+    # floats, with None for missing, unparsable and NaN values.
+    column = []
+    for value in values:
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = None
+        else:
+            if value != value:
+                value = None
+        column.append(value)
+    return column
+
+def in_bounds(raw_device, bounds):
+    lat = LAT_PATTERN.search(raw_device)
+    lon = LON_PATTERN.search(raw_device)
+    if not lat or not lon:
+        return False
+    south, west, north, east = bounds
+    return south <= float(lat.group(1)) <= north and west <= float(lon.group(1)) <= east
+
+class PollScheduler(object):
+    # Per-sensor polling intervals.  A sensor whose lastModified hasn't advanced
+    # since its previous poll is polled half as often, up to max_interval
+    # seconds apart, and goes back to every run as soon as it reports new
+    # data.  Sensors with no parsable location or time are skipped for
+    # negative_ttl seconds.
+    def __init__(self, base_interval=60, max_interval=60 * 60, negative_ttl=6 * 60 * 60):
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.sensors = {}
+        self.unparseable = LRUCache(max_size=10000, ttl=negative_ttl)
+        self.lock = threading.Lock()
+
+    def due(self, device_ids):
+        now = time.time()
+        with self.lock:
+            return [device_id for device_id in device_ids
+                    if self.unparseable.get(device_id) is None and
+                    self.sensors.get(device_id, {}).get('next_poll', 0) <= now]
+
+    def record(self, device_id, last_modified):
+        # last_modified is None when nothing about the sensor could be parsed.
+        now = time.time()
+        with self.lock:
+            if last_modified is None:
+                self.sensors.pop(device_id, None)
+                self.unparseable.set(device_id, now)
+                return
+            state = self.sensors.get(device_id)
+            if state is None or last_modified > state['last_modified']:
+                interval = self.base_interval
+            else:
+                interval = min(self.max_interval, state['interval'] * 2)
+            self.sensors[device_id] = {
+                'last_modified': last_modified,
+                'interval': interval,
+                # Cron runs drift by a few seconds; don't let that skip a run.
+                'next_poll': now + interval - self.base_interval / 2.0,
+            }
+
+    def schedule(self):
+        now = time.time()
+        with self.lock:
+            sensors = dict((device_id, {
+                'interval': state['interval'],
+                'next_poll_in': max(0, int(state['next_poll'] - now)),
+                'last_modified': state['last_modified'],
+            }) for device_id, state in self.sensors.items())
+        return {'sensors': sensors, 'unparseable': sorted(device_id for device_id, _ in self.unparseable.items())}
+
+poll_scheduler = PollScheduler()
+
 class PurpleAirUploader(Uploader):
 
-    def get_all_purple_air_devices(self):
-        body = requests.get('https://www.purpleair.com/json')
-        # Surprisingly, the JSON is in latin1 rather than utf-8
-        # decoded = body.decode('latin1')
-        js = body.json()
-        devices = js['results'][0]
-        for device in devices:
-            yield device
+    def get_all_purple_air_devices(self, bounds=None, device_ids=None):
+        # Stream the global sensor list, yielding only sensors inside bounds
+        # (south, west, north, east) and/or listed in device_ids (a child
+        # channel matches on its ParentID).  Sensors are filtered on their raw
+        # text, so the tens of MB document is never decoded as a whole.  On
+        # App Engine, urlfetch still buffers the whole body (up to its 32 MB
+        # response limit) before iter_content sees it, so there stream=True
+        # saves the decoded objects but not the raw download.
+        url = 'https://www.purpleair.com/json'
+        throttle(url)
+        body = requests.get(url, stream=True)
+        try:
+            # Surprisingly, the JSON is in latin1 rather than utf-8
+            decoder = codecs.getincrementaldecoder(body.encoding or 'latin1')()
+            chunks = (decoder.decode(chunk) for chunk in body.iter_content(64 * 1024))
+            for raw_device in iter_array_items(chunks, 'results'):
+                if device_ids is not None and not any(int(id) in device_ids for id in ID_PATTERN.findall(raw_device)):
+                    continue
+                if bounds is not None and not in_bounds(raw_device, bounds):
+                    continue
+                yield json.loads(raw_device)
+        finally:
+            body.close()
 
     def get_purple_air_device(self, device_id):
-        body = requests.get('https://www.purpleair.com/json?show=%d' % device_id)
+        url = 'https://www.purpleair.com/json?show=%d' % device_id
+        throttle(url)
+        body = requests.get(url)
         # Surprisingly, the JSON is in latin1 rather than utf-8
         # decoded = body.decode('latin1')
         js = body.json()
@@ -25,6 +167,21 @@ class PurpleAirUploader(Uploader):
         for device in devices:
             yield device
 
+    def get_purple_air_devices(self, device_ids, max_ids_per_request=MAX_IDS_PER_REQUEST):
+        # Fetch many sensors with one request per max_ids_per_request IDs.
+        # Returns {device_id: [results]}, where the results for a sensor are
+        # its own entry followed by its child (B channel) entries.
+        device_ids = list(device_ids)
+        devices = {}
+        for start in range(0, len(device_ids), max_ids_per_request):
+            chunk = device_ids[start:start + max_ids_per_request]
+            url = 'https://www.purpleair.com/json?show=%s' % '|'.join('%d' % device_id for device_id in chunk)
+            throttle(url)
+            body = requests.get(url)
+            for device in body.json()['results']:
+                devices.setdefault(device.get('ParentID') or device['ID'], []).append(device)
+        return devices
+
     def make_date_param(self, date):
         return date.strftime('%Y-%m-%d%%20%H:%M:%S')  
 
@@ -34,54 +191,48 @@ class PurpleAirUploader(Uploader):
         return 'https://thingspeak.com/channels/{0}/feed.json?api_key={1}&offset=0&average=&round={2}&start={3}&end={4}'.format(thingspeak_id, api_key, rounding, self.make_date_param(start), self.make_date_param(end))
 
     def get_thingspeak_data(self, device, start, end, rounding=2):
-        body = requests.get(self.get_thingspeak_url(device, start, end, rounding))
+        url = self.get_thingspeak_url(device, start, end, rounding)
+        throttle(url)
+        body = requests.get(url)
         return body.json()
 
-    def upload_thingspeak_data(self, device, start, end, rounding=2):
+    def convert_thingspeak_data(self, thingspeak_data):
+        # One multi-row ESDR upload from a ThingSpeak feed.json response,
+        # converted a column at a time rather than row by row.
+        channel_map = {value:key for key, value in thingspeak_data['channel'].items() if 'field' in key}
+        # TIME is implicit for ESDR;  don't list in channel_names
+        fields = sorted((translated_key, channel_map[key]) for key, translated_key in THINGSPEAK_FIELDS if key in channel_map)
+        feeds = thingspeak_data['feeds']
+        times = parse_utc_column([feed.get('created_at') for feed in feeds])
+        columns = [to_float_column([feed.get(field) for feed in feeds]) for _, field in fields]
+        if None in times:
+            logging.error('Skipping %d ThingSpeak rows without a parsable created_at' % times.count(None))
+        rows = [list(row) for row in zip(times, *columns) if row[0] is not None]
+        return {'channel_names': [translated_key for translated_key, _ in fields], 'data': rows}
+
+    def get_thingspeak_upload(self, device, start, end, rounding=2):
+        # (feed, esdr_upload) with every ThingSpeak sample of device between
+        # start and end, or None if the device has no usable location or data.
         try:
             lat = float(device['Lat'])
             lon = float(device['Lon'])
         except:
             # Ignore if no parsable lat and lon
-            return
-        id = '%s_%06d%s%06d%s' % (device['ID'], 
-                                  round(1000 * abs(lat)), 'NS'[lat < 0], 
-                                  round(1000 * abs(lon)), 'EW'[lon < 0])
-        id = id.replace('.','_')
-
-        thingspeak_data = self.get_thingspeak_data(device, start, end, rounding)
-        channel_map = {value:key for key, value in thingspeak_data['channel'].items() if 'field' in key}
+            return None
+        esdr_upload = self.convert_thingspeak_data(self.get_thingspeak_data(device, start, end, rounding))
+        if not esdr_upload['data']:
+            return None
+        feed = self.getFeed(self.makeId(device['ID'], lat, lon), device['Label'], lat, lon)
+        return feed, esdr_upload
 
-        for feed in thingspeak_data['feeds']:
-            data = {}
-            try:
-                data['time'] = (datetime.datetime.strptime(feed['created_at'], "%Y-%m-%dT%H:%M:%SZ") - datetime.datetime(1970,1,1)).total_seconds()
-            except Exception as e:
-                logging.error(e)
-                return
-
-            for key in ['PM2.5 (CF=1)', 'RSSI', 'Uptime', 'Humidity', 'Temperature']:
-                translated_key = key
-                if key == 'PM2.5 (CF=1)':
-                    translated_key = 'PM2_5'
-                elif key == 'Temperature':
-                    translated_key = 'temp_f'
-                elif key == 'Humidity':
-                    translated_key = 'humidity'
-                try:
-                    data[translated_key] = float(feed[channel_map[key]])
-                except:
-                    pass
-            # Move time to the beginning since that's how ESDR likes it
-            keys = ['time'] + sorted(set(data.keys()).difference(set(['time'])))
-            values = [data[key] for key in keys]
-            if values:
-                # TIME is implicit for ESDR;  don't list in channel_names
-                esdr_upload = {'channel_names':keys[1:], 'data':[values]}
-                name = device['Label']
-                # feed = self.getFeed(id, name, lat, lon)
-                # self.esdr.upload(feed, esdr_upload)
-        logging.info('Uploaded to %s (%s)' % (id, name))
+    def upload_thingspeak_data(self, device, start, end, rounding=2):
+        # For long ranges use the /purpleair/backfill endpoint, which splits
+        # the range into THINGSPEAK_WINDOW requests and checkpoints progress.
+        feed_upload = self.get_thingspeak_upload(device, start, end, rounding)
+        if feed_upload:
+            feed, esdr_upload = feed_upload
+            self.esdr.upload(feed, esdr_upload)
+            logging.info('Uploaded to %s (%s)' % (feed['id'], feed['name']))
 
     def parse_device(self, device):
         try:
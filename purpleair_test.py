@@ -0,0 +1,71 @@
+import main
+
+from purpleair import PollScheduler
+from retry import CircuitOpenError
+
+
+def test_poll_scheduler_backs_off_stale_sensors():
+    scheduler = PollScheduler(base_interval=60, max_interval=240)
+
+    scheduler.record(1, 1000.0)
+    assert scheduler.sensors[1]['interval'] == 60
+    assert scheduler.due([1]) == []
+
+    # lastModified didn't advance: poll half as often, up to max_interval.
+    for interval in (120, 240, 240):
+        scheduler.record(1, 1000.0)
+        assert scheduler.sensors[1]['interval'] == interval
+
+    # New data snaps it back.
+    scheduler.record(1, 2000.0)
+    assert scheduler.sensors[1]['interval'] == 60
+
+
+def test_poll_scheduler_skips_unparseable_sensors():
+    scheduler = PollScheduler()
+
+    scheduler.record(1, None)
+    assert scheduler.due([1, 2]) == [2]
+    assert scheduler.schedule()['unparseable'] == [1]
+
+
+class FakeUploader(object):
+    def __init__(self, error=None):
+        self.error = error
+
+    def parse_device(self, device):
+        if self.error:
+            raise self.error
+        if device.get('Lat') is None:
+            return None
+        return {'id': device['ID']}, {}, {'time': 1000.0}
+
+
+def parse_sensor(monkeypatch, uploader, devices):
+    scheduler = PollScheduler()
+    monkeypatch.setattr(main, 'poll_scheduler', scheduler)
+    connector = main.PurpleAirConnector()
+    connector.uploader = uploader
+    connector.fetch_costs = {}
+    connector.parse_sensor((3765, devices))
+    return scheduler
+
+
+def test_parse_sensor_schedules_by_last_modified(monkeypatch):
+    scheduler = parse_sensor(monkeypatch, FakeUploader(), [{'ID': 3765, 'Lat': '38.1'}])
+    assert scheduler.sensors[3765]['last_modified'] == 1000.0
+
+
+def test_parse_sensor_negative_caches_only_unparseable_sensors(monkeypatch):
+    scheduler = parse_sensor(monkeypatch, FakeUploader(), [{'ID': 3765, 'Lat': None}])
+    assert scheduler.due([3765]) == []
+
+    # A transient ESDR failure while resolving the feed leaves it due.
+    scheduler = parse_sensor(monkeypatch, FakeUploader(CircuitOpenError('ESDR down')), [{'ID': 3765, 'Lat': '38.1'}])
+    assert scheduler.due([3765]) == [3765]
+
+
+def test_parse_sensor_leaves_sensors_missing_from_a_response_due(monkeypatch):
+    scheduler = parse_sensor(monkeypatch, FakeUploader(), [])
+    assert scheduler.due([3765]) == [3765]
+    assert scheduler.schedule()['unparseable'] == []
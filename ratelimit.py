@@ -0,0 +1,71 @@
+import threading, time
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+# (requests per second, burst) per upstream host.  Hosts not listed here are
+# not throttled.  A host has one bucket per process, shared by every connector
+# that calls it, since the limit is the host's.
+DEFAULT_RATE_LIMITS = {
+    'esdr.cmucreatelab.org': (10, 10),
+    'insight.sonomatech.com': (2, 4),
+    'insight2-data.sonomatech.com': (2, 4),
+    'www.purpleair.com': (2, 5),
+    'thingspeak.com': (2, 4),
+    'www.fenceline.org': (1, 2),
+}
+
+class TokenBucket(object):
+    # Callers reserve a token and sleep only until it becomes available, so an
+    # idle host costs nothing and a busy one is spread out at `rate` per second.
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        # Returns how long the caller must wait before using its token.
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def configure(host, rate, burst=1):
+    # Sets the rate of host's bucket for the whole process, not one caller.
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if bucket is None:
+            _buckets[host] = TokenBucket(rate, burst)
+        elif (bucket.rate, bucket.burst) != (float(rate), burst):
+            # Keep the tokens already spent so reconfiguring can't reset the rate.
+            bucket.rate = float(rate)
+            bucket.burst = burst
+
+def get_bucket(host):
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if bucket is None and host in DEFAULT_RATE_LIMITS:
+            bucket = _buckets[host] = TokenBucket(*DEFAULT_RATE_LIMITS[host])
+        return bucket
+
+def throttle(url):
+    # Block until a request to url's host is allowed.  Returns seconds waited.
+    bucket = get_bucket(urlparse(url).netloc)
+    if bucket is None:
+        return 0
+    return bucket.acquire()
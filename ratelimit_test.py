@@ -0,0 +1,83 @@
+import ratelimit
+
+from ratelimit import TokenBucket
+
+
+class FakeClock(object):
+    # Stands in for time.time and time.sleep; sleeping moves the clock.
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def fake_clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit.time, 'time', clock.time)
+    monkeypatch.setattr(ratelimit.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_token_bucket_spreads_requests_after_burst():
+    bucket = TokenBucket(rate=2, burst=2)
+
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    # Out of burst: each further request waits another 1 / rate seconds.
+    assert abs(bucket.reserve() - 0.5) < 0.05
+    assert abs(bucket.reserve() - 1.0) < 0.05
+
+
+def test_idle_bucket_does_not_sleep(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket(rate=1, burst=2)
+
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    # A minute idle refills the burst.
+    clock.now += 60
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert clock.sleeps == []
+
+
+def test_burst_is_paced_at_the_configured_rate(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket(rate=4, burst=2)
+
+    for _ in range(10):
+        bucket.acquire()
+    # Two requests go at once, the other eight a quarter second apart.
+    assert len(clock.sleeps) == 8
+    assert all(abs(seconds - 0.25) < 1e-9 for seconds in clock.sleeps)
+    assert abs(clock.now - 1002.0) < 1e-9
+
+
+def test_throttle_uses_one_bucket_per_host(monkeypatch):
+    fake_clock(monkeypatch)
+    monkeypatch.setattr(ratelimit, '_buckets', {})
+
+    ratelimit.throttle('https://esdr.cmucreatelab.org/api/v1/feeds')
+    ratelimit.throttle('https://esdr.cmucreatelab.org/oauth/token')
+    ratelimit.throttle('https://www.purpleair.com/json?show=1')
+
+    esdr = ratelimit.get_bucket('esdr.cmucreatelab.org')
+    assert (esdr.rate, esdr.burst) == (10, 10)
+    assert esdr.tokens == 8
+    assert ratelimit.get_bucket('www.purpleair.com').tokens == 4
+
+
+def test_unknown_hosts_are_not_throttled(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    monkeypatch.setattr(ratelimit, '_buckets', {})
+
+    for _ in range(100):
+        assert ratelimit.throttle('https://example.com/data') == 0
+    assert clock.sleeps == []
+    assert ratelimit.get_bucket('example.com') is None
@@ -0,0 +1,76 @@
+import random, threading, time
+
+from email.utils import parsedate_tz, mktime_tz
+
+class CircuitOpenError(Exception):
+    pass
+
+class RetryPolicy(object):
+    # Exponential backoff with full jitter: attempt n sleeps a random time in
+    # [0, min(max_delay, base_delay * 2**(n-1))], unless the server said how
+    # long to wait with Retry-After.  Retry-After is capped at max_delay too,
+    # so a server can't keep a request asleep past its deadline.
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30, retry_statuses=(429, 502, 503, 504)):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def should_retry(self, response):
+        return response.status_code in self.retry_statuses
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def retry_after(self, response):
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            date = parsedate_tz(value)
+            if date is None:
+                return None
+            return max(0.0, mktime_tz(date) - time.time())
+
+    def delay(self, attempt, response=None):
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return self.backoff(attempt)
+
+class CircuitBreaker(object):
+    # Opens after `failure_threshold` consecutive failures and then fails fast
+    # for `reset_timeout` seconds.  After that one probe call is let through:
+    # success closes the circuit, failure keeps it open for another timeout.
+    def __init__(self, name, failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at >= self.reset_timeout and not self.probing:
+                self.probing = True
+                return
+            raise CircuitOpenError('%s is unavailable; circuit open after %d consecutive failures' % (self.name, self.failures))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                self.probing = False
@@ -0,0 +1,72 @@
+import pytest, requests
+
+import esdr
+from retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return {}
+
+    def raise_for_status(self):
+        pass
+
+
+def test_delay_prefers_retry_after():
+    policy = RetryPolicy(base_delay=1, max_delay=8)
+
+    assert policy.delay(1, FakeResponse(503, {'Retry-After': '7'})) == 7.0
+    assert policy.delay(1, FakeResponse(503, {'Retry-After': '3600'})) == 8
+    assert 0 <= policy.delay(10, FakeResponse(503)) <= 8
+    assert policy.should_retry(FakeResponse(429))
+    assert not policy.should_retry(FakeResponse(404))
+
+
+def test_breaker_lets_one_probe_through():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+
+    # Open: the first call is the probe, the rest fail fast until it ends.
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # A failed probe keeps it open, a successful one closes it.
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_success()
+    breaker.before_call()
+    breaker.before_call()
+
+
+class FakeSession(object):
+    def __init__(self, errors):
+        self.errors = list(errors)
+
+    def request(self, method, url, **kwargs):
+        error = self.errors.pop(0)
+        if error:
+            raise error
+        return FakeResponse(200)
+
+
+def test_unexpected_error_during_probe_ends_it(monkeypatch):
+    session = FakeSession([requests.ConnectionError(), requests.exceptions.ChunkedEncodingError(), None])
+    monkeypatch.setattr(esdr, 'get_session', lambda prefix, pool_size: session)
+    client = esdr.Esdr('auth.json', prefix='https://esdr.test', retry_policy=RetryPolicy(max_attempts=1))
+    client.breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+
+    with pytest.raises(requests.ConnectionError):
+        client.api('GET', '/api/v1/feeds', oauth=False)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        client.api('GET', '/api/v1/feeds', oauth=False)
+
+    # The failed probe didn't leave the breaker rejecting every call.
+    assert client.api('GET', '/api/v1/feeds', oauth=False) == {}
+    assert client.breaker.opened_at is None
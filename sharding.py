@@ -0,0 +1,143 @@
+import bisect, hashlib, math, threading, time
+
+from cache import JsonFileStore, SnapshotDict, cache_path
+
+try:
+    from google.appengine.ext import ndb
+except ImportError:
+    # Outside App Engine there's nowhere to share costs; shard by plain
+    # consistent hashing.
+    ndb = None
+
+# Seconds one frozen cost snapshot is used for.
+COST_EPOCH = 60 * 60
+
+# Seconds at the start of an epoch during which a shard also polls its
+# sensors of the previous epoch.  At least the time between two cron runs.
+EPOCH_GRACE = 60
+
+def stable_hash(value):
+    # Same value on every instance and run, unlike hash().
+    return int(hashlib.md5(str(value).encode('utf-8')).hexdigest()[:15], 16)
+
+def quantize(cost):
+    # Round to a power of two so small differences between the costs measured
+    # on different instances don't move sensors between shards.
+    return 2.0 ** round(math.log(max(cost, 1e-3), 2))
+
+def assign_shards(sensor_ids, shard_count, costs=None, vnodes=64, slack=0.25):
+    # Split sensor_ids into shard_count lists with consistent hashing, so
+    # changing shard_count only moves about 1/shard_count of the sensors.
+    # With per-sensor costs (seconds per run) the hashing is bounded-load: a
+    # shard takes no more than (1 + slack) times its fair share of the total
+    # cost, and sensors that would overflow it move to the next shard on the
+    # ring.  Sensors without a measured cost count as the median cost.  Every
+    # shard must be assigned from the same costs; see frozen_costs.
+    costs = costs or {}
+    known = sorted(quantize(costs[sensor_id]) for sensor_id in sensor_ids if sensor_id in costs)
+    default_cost = known[len(known) // 2] if known else 1.0
+    sensor_costs = dict((sensor_id, quantize(costs[sensor_id]) if sensor_id in costs else default_cost)
+                        for sensor_id in sensor_ids)
+    capacity = (1 + slack) * sum(sensor_costs.values()) / shard_count
+
+    ring = sorted((stable_hash('shard-%d-%d' % (shard, vnode)), shard)
+                  for shard in range(shard_count) for vnode in range(vnodes))
+    points = [point for point, _ in ring]
+    shards = dict((shard, []) for shard in range(shard_count))
+    loads = dict((shard, 0.0) for shard in range(shard_count))
+    # Costliest sensors first so they get their first-choice shard.
+    for sensor_id in sorted(sensor_ids, key=lambda sensor_id: (-sensor_costs[sensor_id], stable_hash(sensor_id))):
+        cost = sensor_costs[sensor_id]
+        start = bisect.bisect(points, stable_hash(sensor_id))
+        chosen = None
+        for i in range(len(ring)):
+            shard = ring[(start + i) % len(ring)][1]
+            if loads[shard] + cost <= capacity:
+                chosen = shard
+                break
+        if chosen is None:
+            chosen = min(loads, key=lambda shard: (loads[shard], shard))
+        shards[chosen].append(sensor_id)
+        loads[chosen] += cost
+    return shards
+
+if ndb is not None:
+    class ShardCosts(ndb.Model):
+        # The sensor costs every shard assigns sensors from, for the two
+        # newest epochs: {str(epoch): {str(sensor id): cost}}.  One entity
+        # per name, so old epochs don't pile up.
+        epochs = ndb.JsonProperty(compressed=True)
+
+_frozen = {}
+_frozen_lock = threading.Lock()
+
+def frozen_costs(name, epoch, measured):
+    # The costs `name`'s shards use in `epoch`, the same on every instance:
+    # the first shard to run in an epoch stores its measured costs and all
+    # the others read them back.  Shards assigned from different cost maps
+    # wouldn't add up to every sensor exactly once.  None (plain consistent
+    # hashing) without Datastore.
+    if ndb is None:
+        return None
+    key = '%s-%d' % (name, epoch)
+    with _frozen_lock:
+        costs = _frozen.get(key)
+    if costs is None:
+        costs = dict((int(sensor_id), cost) for sensor_id, cost in freeze_costs(name, epoch, measured).items())
+        with _frozen_lock:
+            if len(_frozen) > 10:
+                _frozen.clear()
+            _frozen[key] = costs
+    return costs
+
+def freeze_costs(name, epoch, measured):
+    # The costs stored for `epoch` in name's ShardCosts, storing measured()
+    # if there are none yet.  Only the two newest epochs are kept: the
+    # current one and the one its grace period still polls.
+    @ndb.transactional
+    def freeze():
+        snapshot = ShardCosts.get_by_id(name) or ShardCosts(id=name, epochs={})
+        epochs = snapshot.epochs
+        costs = epochs.get(str(epoch))
+        if costs is None:
+            costs = epochs[str(epoch)] = dict((str(sensor_id), cost) for sensor_id, cost in measured().items())
+            for stale in sorted(epochs, key=int)[:-2]:
+                del epochs[stale]
+            snapshot.put()
+        return costs
+    return freeze()
+
+def get_shard(name, sensor_ids, shard, shard_count, now=None):
+    # The sensors shard `shard` of `shard_count` polls at `now`.  Early in an
+    # epoch it polls its sensors of the previous epoch too, so a sensor that
+    # moved isn't missed by a shard that ran just before the change.
+    now = now if now is not None else time.time()
+    epoch = int(now // COST_EPOCH)
+    sensor_ids = sorted(sensor_ids)
+    sensors = set(assign_shards(sensor_ids, shard_count, frozen_costs(name, epoch, sensor_costs.get_all))[shard])
+    if now - epoch * COST_EPOCH < EPOCH_GRACE:
+        sensors.update(assign_shards(sensor_ids, shard_count, frozen_costs(name, epoch - 1, sensor_costs.get_all))[shard])
+    return sensors
+
+class SensorCosts(object):
+    # Moving average of the seconds each sensor costs a run (its share of the
+    # fetch plus parsing and feed resolution), snapshotted under AWBA_CACHE_DIR.
+    def __init__(self, alpha=0.3, path=None):
+        self.alpha = alpha
+        self.costs = SnapshotDict(JsonFileStore(path), decode=lambda costs: dict(
+            (int(sensor_id), cost) for sensor_id, cost in costs.items()))
+
+    def record(self, sensor_id, seconds):
+        with self.costs as costs:
+            previous = costs.get(sensor_id)
+            costs[sensor_id] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+
+    def get_all(self):
+        with self.costs as costs:
+            return dict(costs)
+
+    def save(self):
+        with self.costs:
+            self.costs.save()
+
+sensor_costs = SensorCosts(path=cache_path('sensor_costs.json'))
@@ -0,0 +1,51 @@
+import random
+
+import sharding
+
+from sharding import COST_EPOCH, EPOCH_GRACE, assign_shards, get_shard
+
+SENSORS = range(1000, 1030)
+
+
+def assert_partition(shards, sensor_ids):
+    assigned = [sensor_id for shard in shards for sensor_id in shard]
+    assert sorted(assigned) == sorted(sensor_ids)
+
+
+def test_shards_partition_the_sensors():
+    costs = dict((sensor_id, random.uniform(0.1, 5)) for sensor_id in SENSORS)
+    for shard_count in (1, 2, 3, 7):
+        shards = assign_shards(SENSORS, shard_count, costs)
+        assert_partition(shards.values(), SENSORS)
+        # Every shard computes the same assignment from the same costs.
+        assert assign_shards(list(reversed(SENSORS)), shard_count, dict(costs)) == shards
+
+
+def test_adding_a_shard_moves_few_sensors():
+    before = assign_shards(SENSORS, 3)
+    after = assign_shards(SENSORS, 4)
+    owner = lambda shards: dict((sensor_id, shard) for shard, ids in shards.items() for sensor_id in ids)
+    moved = [sensor_id for sensor_id in SENSORS if owner(before)[sensor_id] != owner(after)[sensor_id]]
+    assert len(moved) < len(SENSORS) / 2
+
+
+def test_shards_cover_every_sensor_across_an_epoch_change(monkeypatch):
+    # Each epoch's frozen costs differ, so sensors move between shards.
+    epoch_costs = {}
+
+    def frozen_costs(name, epoch, measured):
+        return epoch_costs.setdefault(epoch, dict((sensor_id, random.uniform(0.1, 5)) for sensor_id in SENSORS))
+
+    monkeypatch.setattr(sharding, 'frozen_costs', frozen_costs)
+    change = 100 * COST_EPOCH
+
+    # Mid-epoch the shards are a partition.
+    assert_partition([get_shard('test', SENSORS, shard, 3, change + EPOCH_GRACE) for shard in range(3)], SENSORS)
+
+    # Around the change each shard runs once per EPOCH_GRACE, some before it
+    # and some after; between them they still poll every sensor.
+    for offsets in ([-10, 5, 30], [-50, -1, 0], [1, 20, 59]):
+        polled = set()
+        for shard, offset in enumerate(offsets):
+            polled |= get_shard('test', SENSORS, shard, 3, change + offset)
+        assert polled == set(SENSORS)
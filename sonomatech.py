@@ -0,0 +1,595 @@
+import calendar, json, logging, threading, time
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from cache import JsonFileStore, SnapshotDict, snapshot_store
+from esdr import get_session
+from pipeline import parallel_map
+from ratelimit import throttle
+from timeutil import utc_to_epoch
+from wind import WindUploads, get_wind_aggregator, to_mph
+from uploader import Uploader
+
+Feed = namedtuple('Feed', ['id', 'name', 'lat', 'lon'])
+
+DATA_PATH = "/data/filterAsJson"
+
+WIND_DATA_PATH = "/WindData/filterAsJson"
+
+# Connections kept open to each Sonoma Tech API.  Like ESDR's (see
+# esdr.get_session), the pool only takes effect off App Engine; there every
+# request goes through urlfetch.
+POOL_SIZE = 10
+
+# Seconds before a data request is given up on.
+REQUEST_TIMEOUT = 20
+
+# Words in the messages of a failed response that mean the token was refused.
+AUTH_FAILURE_WORDS = ('token', 'expired', 'unauthorized', 'authenticat')
+
+def decode_body(response):
+    # The decoded JSON body, or None.  JSON is UTF-8, so json.loads can take
+    # the raw bytes and skip requests' charset detection and text decoding.
+    try:
+        return json.loads(response.content)
+    except ValueError:
+        return None
+
+def is_auth_failure(status_code, body):
+    # True for 401/403, and for 200 responses whose payload reports a failure
+    # because of the token.  Anything else is not fixed by logging in again.
+    if status_code in (401, 403):
+        return True
+    if status_code != 200:
+        return False
+    if not isinstance(body, dict) or not (body.get('error') or body.get('isFailure')):
+        return False
+    messages = ' '.join(str(message) for message in body.get('messages') or []).lower()
+    return any(word in messages for word in AUTH_FAILURE_WORDS)
+
+class SonomaTechSession(object):
+    # Login token and keep-alive connections for one Sonoma Tech API, shared
+    # by every uploader in the process.  The token is fetched on first use and
+    # kept until the API refuses it.  `generation` counts logins, so when
+    # several threads see the same token refused only the first logs in again
+    # and the rest pick up its token.
+    def __init__(self, base_url, auth, headers, session=None):
+        self.base_url = base_url
+        self.auth = auth
+        self.headers = headers
+        self.session = session or get_session(base_url, POOL_SIZE)
+        self.token = None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def login(self):
+        # Callers must hold self.lock, which blocks every other request to
+        # this API, so the login must not hang.
+        url = self.base_url + '/Auth/User/login'
+        throttle(url)
+        response = self.session.post(url, data=self.auth, headers=self.headers, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        self.token = response.json()
+        self.generation += 1
+        logging.info('Logged in to %s' % self.base_url)
+
+    def get_token(self):
+        with self.lock:
+            if self.token is None:
+                self.login()
+            return self.token, self.generation
+
+    def invalidate(self, generation):
+        with self.lock:
+            if self.generation == generation:
+                self.token = None
+
+    def post(self, path, build_body, timeout=None):
+        # POST build_body(token) to path and return the decoded body, logging
+        # in again and retrying once if the token was refused.
+        return self.timed_post(path, build_body, timeout)[0]
+
+    def timed_post(self, path, build_body, timeout=None):
+        # post(), also returning the seconds the server took to answer: the
+        # last request and its decoding, without the rate limiter's wait or
+        # a login.
+        url = self.base_url + path
+        for attempt in range(2):
+            token, generation = self.get_token()
+            throttle(url)
+            started = time.time()
+            response = self.session.post(url, data=build_body(token), headers=self.headers, timeout=timeout)
+            body = decode_body(response)
+            seconds = time.time() - started
+            if attempt == 0 and is_auth_failure(response.status_code, body):
+                logging.info('%s refused the token, logging in again' % self.base_url)
+                self.invalidate(generation)
+                continue
+            break
+        response.raise_for_status()
+        return body, seconds
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_sonomatech_session(base_url, auth, headers):
+    with _sessions_lock:
+        session = _sessions.get(base_url)
+        if session is None:
+            session = _sessions[base_url] = SonomaTechSession(base_url, auth, headers)
+        return session
+
+# Request windows.  A stream (one kind of request for one set of sites) that
+# has never been fetched starts FIRST_WINDOW ago.  Sites that lag behind the
+# stream by less than SETTLE_TIME are looked for again from their newest row,
+# for rows that reach the server late; a site further behind is down, not
+# late, and doesn't widen every request.  Gaps left by runs that failed are
+# paged through MAX_WINDOW at a time, MAX_WINDOWS_PER_RUN per run, going back
+# at most MAX_CATCH_UP.
+FIRST_WINDOW = timedelta(minutes=10)
+SETTLE_TIME = timedelta(minutes=15)
+MAX_WINDOW = timedelta(hours=2)
+MAX_WINDOWS_PER_RUN = 4
+MAX_CATCH_UP = timedelta(days=7)
+
+def format_date(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%S')
+
+def check_body(body, key, required=True):
+    # body[key] from a decoded data or wind response, raising if the server
+    # reported a failure.
+    if not isinstance(body, dict):
+        raise Exception('The server responded with something other than a JSON object.')
+    if body.get('error'):
+        raise Exception((body.get('messages') or ['The server reported an error.'])[0])
+    if body.get('isFailure'):
+        raise Exception('The server responded with a failure.')
+    if key not in body:
+        if required:
+            raise Exception('The server omitted %s field.' % key)
+        return []
+    return body[key]
+
+class SiteWatermarks(object):
+    # Per stream, how far it has been fetched ('cursor') and the newest row
+    # seen from each site, as epoch seconds, kept in `store` (memory by
+    # default).  windows() asks only for what's new when caught up, and pages
+    # through the gap after an outage until it is.
+    def __init__(self, store=None):
+        self.streams = SnapshotDict(store or JsonFileStore(None))
+
+    def windows(self, stream, site_ids, now=None):
+        # [(start, end)] UTC datetimes to request next, oldest first.
+        now = now if now is not None else time.time()
+        with self.streams.using([stream]) as streams:
+            state = streams.get(stream, {})
+            cursor = state.get('cursor', now - FIRST_WINDOW.total_seconds())
+            cursor = max(cursor, now - MAX_CATCH_UP.total_seconds())
+            settled = cursor - SETTLE_TIME.total_seconds()
+            sites = state.get('sites', {})
+            start = min([cursor] + [sites[str(site_id)] for site_id in site_ids
+                                    if sites.get(str(site_id), settled) > settled])
+        windows = []
+        while start < now and len(windows) < MAX_WINDOWS_PER_RUN:
+            end = min(start + MAX_WINDOW.total_seconds(), now)
+            windows.append((datetime.utcfromtimestamp(start), datetime.utcfromtimestamp(end)))
+            start = end
+        return windows
+
+    def advance(self, stream, end, rows):
+        # Record that the window ending at `end` was fetched completely and
+        # its `rows` delivered.
+        end = calendar.timegm(end.utctimetuple())
+        with self.streams.using([stream]) as streams:
+            state = streams.setdefault(stream, {'cursor': end, 'sites': {}})
+            state['cursor'] = max(state['cursor'], end)
+            sites = state['sites']
+            for row in rows:
+                site_id = str(row['siteId'])
+                sites[site_id] = max(sites.get(site_id, 0), utc_to_epoch(row['utc']))
+            self.streams.save([stream])
+
+# Shared by every instance, so a restart or a deploy doesn't lose the gap to
+# catch up, and whichever instance serves a run starts where the last one
+# stopped.
+site_watermarks = SiteWatermarks(snapshot_store('sonomatech_sites'))
+
+class QcCodeHistory(object):
+    # The last QC code of each QC feed channel, with the data time it was
+    # seen at and last uploaded at, kept in `store` (memory by default).  QC
+    # codes rarely change, so a code is only uploaded when it differs from
+    # the last one, or as a keyframe once `keyframe_interval` seconds of data
+    # time have passed since it was last uploaded.
+    def __init__(self, store=None):
+        self.codes = SnapshotDict(store or JsonFileStore(None))
+
+    def changes(self, feed_id, epoch, qc_data, keyframe_interval, staged):
+        # The channels of qc_data (one QC row at `epoch`) worth uploading.
+        # The states this decides on go to `staged` rather than the history,
+        # and are read back from it first, until commit(staged).
+        changed = {}
+        keys = dict((channel, '%s|%s' % (feed_id, channel)) for channel in qc_data)
+        # Channels already staged this run needn't be read again.
+        with self.codes.using([key for key in keys.values() if key not in staged]) as codes:
+            for channel, code in qc_data.items():
+                key = keys[channel]
+                last = staged.get(key) or codes.get(key)
+                if last is not None and epoch < last['seen']:
+                    # A late row; newer rows already decided.
+                    continue
+                if last is None or code != last['code'] or epoch - last['uploaded'] >= keyframe_interval:
+                    changed[channel] = code
+                    staged[key] = {'code': code, 'seen': epoch, 'uploaded': epoch}
+                else:
+                    staged[key] = dict(last, seen=epoch)
+        return changed
+
+    def commit(self, staged):
+        with self.codes.using(list(staged)) as codes:
+            codes.update(staged)
+            self.codes.save(list(staged))
+
+class QcCodeUploads(object):
+    # The QC code states one run decided on, per QC feed, kept out of
+    # `history` until that feed's upload succeeds, like upload_history: a
+    # change that never reached ESDR is sent again next run instead of
+    # waiting for a keyframe.
+    def __init__(self, history):
+        self.history = history
+        self.staged = {}
+        # QC feed id -> the ESDR feed its changes went to (None until one
+        # was looked up), for the QC feeds with changes to upload.
+        self.esdr_feeds = {}
+
+    def changes(self, feed_id, epoch, qc_data, keyframe_interval):
+        changed = self.history.changes(feed_id, epoch, qc_data, keyframe_interval,
+                                       self.staged.setdefault(feed_id, {}))
+        if changed:
+            self.esdr_feeds.setdefault(feed_id, None)
+        return changed
+
+    def sent_to(self, feed_id, esdr_feed):
+        self.esdr_feeds[feed_id] = esdr_feed['id']
+
+    def commit(self, uploaded_feeds):
+        # Keep the states of the QC feeds that had nothing to upload or whose
+        # ESDR feed is in uploaded_feeds; forget the rest.
+        staged = {}
+        for feed_id, states in self.staged.items():
+            if feed_id not in self.esdr_feeds or self.esdr_feeds[feed_id] in uploaded_feeds:
+                staged.update(states)
+        self.history.commit(staged)
+        self.staged = {}
+        self.esdr_feeds = {}
+
+# Shared by every instance, so one that served an earlier run doesn't compare
+# codes with what it saw itself rather than what was last uploaded.
+qc_code_history = QcCodeHistory(snapshot_store('sonomatech_qc'))
+
+class ParameterGroups(object):
+    # Request groups of parameters, resized after every run: a group that
+    # failed or timed out is split in two, and neighbouring groups that both
+    # answered within `fast_response` seconds are merged, up to `max_size`
+    # parameters.  Fewer, bigger requests when the server is healthy; smaller
+    # ones, so one bad parameter costs less, when it isn't.
+    def __init__(self, groups, fast_response=2, max_size=16):
+        self.groups = [list(group) for group in groups]
+        self.fast_response = fast_response
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            return [list(group) for group in self.groups]
+
+    def update(self, results):
+        # results: [(group, ok, seconds)] for the groups returned by get().
+        groups = []
+        mergeable = False
+        for group, ok, seconds in results:
+            fast = ok and seconds < self.fast_response
+            if not ok and len(group) > 1:
+                middle = len(group) // 2
+                groups += [group[:middle], group[middle:]]
+                mergeable = False
+            elif fast and mergeable and len(groups[-1]) + len(group) <= self.max_size:
+                groups[-1] = groups[-1] + group
+                mergeable = False
+            else:
+                groups.append(group)
+                mergeable = fast
+        with self.lock:
+            self.groups = groups
+
+_parameter_groups = {}
+_parameter_groups_lock = threading.Lock()
+
+def get_parameter_groups(stream, groups):
+    with _parameter_groups_lock:
+        parameter_groups = _parameter_groups.get(stream)
+        if parameter_groups is None:
+            parameter_groups = _parameter_groups[stream] = ParameterGroups(groups)
+        return parameter_groups
+
+# A site's feed and QC feed.
+SiteFeeds = namedtuple('SiteFeeds', ['feed', 'qc_feed'])
+
+# siteId -> (siteName, latitude, longitude, SiteFeeds or None) as last seen
+# in a row, so makeId and the Feeds are built once per site per process.  A
+# row that doesn't match its entry (a site moved) replaces it.
+_site_index = {}
+
+class SonomaTechUploader(Uploader):
+    # Fetches and parses the measurements and wind of one Sonoma Tech site
+    # list.  Subclasses configure it with the attributes below.
+    BASE_URL = None
+    AUTH = None
+    HEADERS = None
+    SITE_IDS = []
+    # Parameters asked for in one data request, to start with.
+    PARAMETER_GROUPS = []
+    WIND_SITE_IDS = []
+    # Fields of the wind request's 'input' beyond sites and dates, and the
+    # rest of its form.
+    WIND_INPUT = {}
+    WIND_FORM = {}
+    # Whether a response without its 'data' or 'windData' array is a failure
+    # rather than no data.
+    REQUIRE_DATA = True
+    # Seconds of data between uploads of an unchanged QC code; None uploads
+    # every QC code.
+    QC_KEYFRAME_INTERVAL = 60 * 60
+    # Wind rows summarize the WIND_WINDOW seconds before every multiple of
+    # WIND_STEP seconds.
+    WIND_WINDOW = 5 * 60
+    WIND_STEP = 5 * 60
+    # SiteWatermarks streams of the data and wind requests.
+    DATA_STREAM = None
+    WIND_STREAM = None
+
+    def __init__(self, esdr, product):
+        super(SonomaTechUploader, self).__init__(esdr, product)
+        self.sonomatech = get_sonomatech_session(self.BASE_URL, self.AUTH, self.HEADERS)
+        self.failed_groups = []
+        # (stream, end, rows) of the windows fetched completely this run,
+        # oldest first, until commit_windows.
+        self.fetched_windows = []
+        self.qc_codes = QcCodeUploads(qc_code_history)
+        self.wind_summaries = WindUploads(get_wind_aggregator(self.WIND_STREAM, self.WIND_WINDOW, self.WIND_STEP))
+
+    def build_data_request_body(self, token, parameters, start, end, site_ids=None):
+        return {
+            'input' : json.dumps({
+                "dataStreams": [],
+                "siteIds": site_ids if site_ids is not None else self.SITE_IDS,
+                "parameters": parameters,
+                "durationId": 2,
+                "aggregateId": 0,
+                "publicDataOnly": False,
+                "primaryDataOnly": False,
+                "validDataOnly": False,
+                "selectedDateTime": format_date(end),
+                "startDateTime": format_date(start),
+                "endDateTime": format_date(end),
+                "isUtc": True,
+            }),
+            "token": token,
+            "type" : "defaultJson",
+            "fillMissingPoints": False,
+        }
+
+    def build_wind_request_body(self, token, site_ids, start, end):
+        request_input = {
+            "dataStreams": [],
+            "siteIds": site_ids,
+            "aggregateId": 0,
+            "publicDataOnly": False,
+            "primaryDataOnly": False,
+            "validDataOnly": False,
+            "selectedDateTime": format_date(end),
+            "startDateTime": format_date(start),
+            "endDateTime": format_date(end),
+            "isUtc": True,
+        }
+        request_input.update(self.WIND_INPUT)
+        body = {
+            'input': json.dumps(request_input),
+            "token": token,
+        }
+        body.update(self.WIND_FORM)
+        return body
+
+    def request_data(self, parameters, start, end, site_ids=None):
+        return self.timed_request_data(parameters, start, end, site_ids)[0]
+
+    def timed_request_data(self, parameters, start, end, site_ids=None):
+        # (rows, seconds the server took to answer)
+        body, seconds = self.sonomatech.timed_post(
+            DATA_PATH,
+            lambda token: self.build_data_request_body(token, parameters, start, end, site_ids),
+            timeout=REQUEST_TIMEOUT
+        )
+        return check_body(body, 'data', self.REQUIRE_DATA), seconds
+
+    def request_wind_data(self, site_ids, start, end):
+        body = self.sonomatech.post(
+            WIND_DATA_PATH,
+            lambda token: self.build_wind_request_body(token, site_ids, start, end),
+            timeout=REQUEST_TIMEOUT
+        )
+        return check_body(body, 'windData', self.REQUIRE_DATA)
+
+    def fetch_group(self, params, start, end):
+        # (params, rows or None if the request failed, seconds the server
+        # took to answer).  Only the server's time counts, so groups queued
+        # behind the rate limiter don't look slow to ParameterGroups.
+        try:
+            devices, seconds = self.timed_request_data(params, start, end)
+        except Exception as e:
+            logging.warning('Failure for params: %s' % params)
+            logging.warning(e)
+            return params, None, None
+        return params, devices, seconds
+
+    def fetch_window(self, start, end):
+        # All groups at once; the Sonoma Tech rate limit spaces them out.
+        parameter_groups = get_parameter_groups(self.DATA_STREAM, self.PARAMETER_GROUPS)
+        groups = parameter_groups.get()
+        results = sorted(parallel_map(lambda params: self.fetch_group(params, start, end), groups, len(groups)),
+                         key=lambda result: groups.index(result[0]))
+        failed_groups = [params for params, devices, _ in results if devices is None]
+        parameter_groups.update([(params, devices is not None, seconds) for params, devices, seconds in results])
+        data = []
+        for params, devices, _ in results:
+            if devices is not None:
+                data += devices
+        return data, failed_groups
+
+    def fetch_devices(self):
+        data = []
+        self.failed_groups = []
+        for start, end in site_watermarks.windows(self.DATA_STREAM, self.SITE_IDS):
+            devices, self.failed_groups = self.fetch_window(start, end)
+            data += devices
+            if self.failed_groups:
+                # Fetch the whole window again next run.
+                break
+            self.fetched_windows.append((self.DATA_STREAM, end, devices))
+        return data
+
+    def fetch_wind_devices(self):
+        data = []
+        for start, end in site_watermarks.windows(self.WIND_STREAM, self.WIND_SITE_IDS):
+            try:
+                devices = self.request_wind_data(self.WIND_SITE_IDS, start, end)
+            except Exception as e:
+                logging.warning(e)
+                break
+            self.fetched_windows.append((self.WIND_STREAM, end, devices))
+            data += devices
+        return data
+
+    def commit_windows(self, streams):
+        # Move the watermarks of `streams` past the windows fetched this run,
+        # once their rows have been delivered.  The windows of other streams
+        # are fetched again next run.
+        for stream, end, rows in self.fetched_windows:
+            if stream in streams:
+                site_watermarks.advance(stream, end, rows)
+            else:
+                logging.warning('Will fetch %s up to %s again: not all of its rows were delivered' % (stream, format_date(end)))
+        self.fetched_windows = []
+
+    def get_site_feeds(self, device):
+        # SiteFeeds for a row's site, or None if its lat/lon don't parse.
+        site = _site_index.get(device['siteId'])
+        if site is None or site[:3] != (device['siteName'], device['latitude'], device['longitude']):
+            try:
+                lat = float(device['latitude'])
+                lon = float(device['longitude'])
+            except (TypeError, ValueError):
+                site_feeds = None
+            else:
+                id = self.makeId(device['siteId'], lat, lon)
+                name = device['siteName']
+                site_feeds = SiteFeeds(Feed(id, name, lat, lon), Feed(id + '_qc', name + '_qc', lat, lon))
+            site = _site_index[device['siteId']] = (device['siteName'], device['latitude'], device['longitude'], site_feeds)
+        return site[3]
+
+    def parse_devices(self, devices, qc_codes=None):
+        # Rows are grouped on (feed id, utc); each group is one row for the
+        # site's feed (valid QC only) and one for its QC feed, which keeps
+        # only the codes qc_codes (QcCodeUploads, self.qc_codes by default)
+        # says are worth uploading.
+        if qc_codes is None:
+            qc_codes = self.qc_codes
+        groups = {}
+        channels = {}
+        unlocated = 0
+        for device in devices:
+            site_feeds = self.get_site_feeds(device)
+            if site_feeds is None:
+                unlocated += 1
+                continue
+            key = (site_feeds.feed.id, device['utc'])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (site_feeds, {}, [], {}, [])
+            _, data, raw_data, qc_data, qc_raw_data = group
+            parameter_name = device['parameterName']
+            channel = channels.get(parameter_name)
+            if channel is None:
+                param_name = parameter_name.replace('-', '_')
+                channel = channels[parameter_name] = (param_name, param_name + '_qcCode')
+            qc_raw_data.append(device)
+            qc_data[channel[1]] = device['qcCode']
+            if not device['qcCode'] == 9: # Invalid QC
+                raw_data.append(device)
+                data[channel[0]] = device['value']
+        if unlocated:
+            logging.warning('Skipped %d rows without a parsable latitude and longitude' % unlocated)
+        esdr_feeds = {}
+        # In time order, so QC codes are compared with the one before them.
+        for (_, utc), (site_feeds, data, raw_data, qc_data, qc_raw_data) in sorted(groups.iteritems(), key=lambda item: item[0][1]):
+            epoch = utc_to_epoch(utc)
+            if self.QC_KEYFRAME_INTERVAL is not None:
+                qc_data = qc_codes.changes(site_feeds.qc_feed.id, epoch, qc_data, self.QC_KEYFRAME_INTERVAL)
+            for feed, feed_data, feed_raw_data in ((site_feeds.qc_feed, qc_data, qc_raw_data),
+                                                   (site_feeds.feed, data, raw_data)):
+                if not feed_data or not feed_raw_data:
+                    continue
+                esdr_feed = esdr_feeds.get(feed)
+                if esdr_feed is None:
+                    esdr_feed = esdr_feeds[feed] = self.getFeed(*feed)
+                    if feed is site_feeds.qc_feed:
+                        qc_codes.sent_to(feed.id, esdr_feed)
+                feed_data['time'] = epoch
+                yield esdr_feed, self.makeEsdrUpload(feed_data), feed_raw_data
+
+    def parse_wind_devices(self, devices, aggregator=None, flush=False):
+        # One row per feed per WIND_STEP boundary with the strongest gust
+        # (and its direction), mean speed and vector mean direction of the
+        # WIND_WINDOW before it.  With flush, the last boundary of each feed
+        # is emitted without waiting for a later sample.  The aggregator is
+        # self.wind_summaries (WindUploads) by default.
+        if aggregator is None:
+            aggregator = self.wind_summaries
+        samples = []
+        for device in devices:
+            site_feeds = self.get_site_feeds(device)
+            if site_feeds is None:
+                logging.warning('Skipped a wind row without a parsable latitude and longitude')
+                continue
+            if device['windSpeed'] is None or device['windDirection'] is None:
+                continue
+            speed = to_mph(device['windSpeed'], device['unitName'])
+            if speed is None:
+                logging.warning('Skipped a wind row in unknown unit %s' % device['unitName'])
+                continue
+            samples.append((utc_to_epoch(device['utc']), site_feeds.feed, speed, device))
+        samples.sort(key=lambda sample: sample[0])
+        summaries = []
+        for epoch, feed, speed, device in samples:
+            summaries += [(feed, summary) for summary in aggregator.add(feed.id, epoch, speed, device['windDirection'], device)]
+        if flush:
+            for feed in set(feed for _, feed, _, _ in samples):
+                summary = aggregator.flush(feed.id)
+                if summary:
+                    summaries.append((feed, summary))
+        esdr_feeds = {}
+        for feed, summary in summaries:
+            data = {
+                'time': summary['time'],
+                'Wind_Speed_MPH': summary['max_speed'],
+                'Wind_Direction': summary['gust_direction'],
+                'Wind_Speed_Mean_MPH': summary['mean_speed'],
+                'Wind_Direction_Vector_Mean': summary['vector_mean_direction'],
+            }
+            if summary['gust_sample']['unitName'] == 'm/s':
+                data['Wind_Speed_MS'] = summary['gust_sample']['windSpeed']
+            esdr_feed = esdr_feeds.get(feed)
+            if esdr_feed is None:
+                esdr_feed = esdr_feeds[feed] = self.getFeed(*feed)
+                aggregator.sent_to(feed.id, esdr_feed)
+            yield esdr_feed, self.makeEsdrUpload(data), summary['samples']
@@ -0,0 +1,206 @@
+import json, time
+
+from datetime import datetime
+
+import sonomatech
+
+from sonomatech import QcCodeHistory, QcCodeUploads, SiteWatermarks, SonomaTechSession, SonomaTechUploader
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = json.dumps(body)
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession(object):
+    # Accepts only the token from the latest login.
+    def __init__(self, login_seconds=0):
+        self.logins = 0
+        self.login_seconds = login_seconds
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        if url.endswith('/Auth/User/login'):
+            time.sleep(self.login_seconds)
+            self.logins += 1
+            return FakeResponse(200, 'token-%d' % self.logins)
+        if data['token'] != 'token-%d' % self.logins:
+            return FakeResponse(401, {})
+        return FakeResponse(200, {'data': []})
+
+
+def test_token_is_reused_until_refused():
+    session = SonomaTechSession('https://sonomatech.example/api', {}, {}, session=FakeSession())
+    build_body = lambda token: {'token': token}
+
+    session.post('/data/filterAsJson', build_body)
+    session.post('/data/filterAsJson', build_body)
+    assert session.session.logins == 1
+
+    # Another process logged in and the old token stopped working.
+    session.session.logins += 1
+    assert session.post('/data/filterAsJson', build_body) == {'data': []}
+    assert session.session.logins == 3
+    assert session.token == 'token-3'
+
+
+def test_timed_post_leaves_out_the_login():
+    session = SonomaTechSession('https://sonomatech.example/api', {}, {}, session=FakeSession(login_seconds=0.2))
+
+    body, seconds = session.timed_post('/data/filterAsJson', lambda token: {'token': token})
+    assert body == {'data': []}
+    assert seconds < 0.1
+
+
+class FakeUploader(SonomaTechUploader):
+    def __init__(self):
+        self.product = {'id': 1}
+
+    def getFeed(self, id, name, lat, lon):
+        return {'id': id, 'name': name}
+
+
+def test_data_request_asks_for_the_given_sites_only():
+    uploader = FakeUploader()
+    uploader.SITE_IDS = [11, 12]
+
+    def site_ids(**kwargs):
+        body = uploader.build_data_request_body('token', [1], utc(NOW - 60), utc(NOW), **kwargs)
+        return json.loads(body['input'])['siteIds']
+
+    assert site_ids() == [11, 12]
+    assert site_ids(site_ids=[12]) == [12]
+    assert site_ids(site_ids=[]) == []
+
+
+def test_parse_devices_skips_rows_without_location():
+    row = {'siteId': 1, 'siteName': 'Site', 'latitude': '37.9', 'longitude': '-122.3',
+           'utc': '2020-05-17 22:15:00', 'parameterName': 'PM-25', 'qcCode': 0, 'value': 4.0}
+    unlocated = dict(row, latitude=None, parameterName='Ozone', value=30.0)
+    invalid = dict(row, parameterName='SO2', qcCode=9, value=-1.0)
+
+    uploads = dict((feed['id'], esdr_data) for feed, esdr_data, _ in
+                   FakeUploader().parse_devices([row, unlocated, invalid], QcCodeUploads(QcCodeHistory())))
+
+    assert uploads['1_037900N122300W'] == {'channel_names': ['PM_25'], 'data': [[1589753700.0, 4.0]]}
+    assert uploads['1_037900N122300W_qc'] == {'channel_names': ['PM_25_qcCode', 'SO2_qcCode'],
+                                              'data': [[1589753700.0, 0, 9]]}
+
+
+def test_qc_codes_upload_on_change_and_keyframe():
+    qc_codes = QcCodeUploads(QcCodeHistory())
+
+    assert qc_codes.changes('qc', 0, {'PM_25_qcCode': 0}, 3600) == {'PM_25_qcCode': 0}
+    assert qc_codes.changes('qc', 300, {'PM_25_qcCode': 0}, 3600) == {}
+    assert qc_codes.changes('qc', 600, {'PM_25_qcCode': 9}, 3600) == {'PM_25_qcCode': 9}
+    assert qc_codes.changes('qc', 3900, {'PM_25_qcCode': 9}, 3600) == {}
+    assert qc_codes.changes('qc', 4200, {'PM_25_qcCode': 9}, 3600) == {'PM_25_qcCode': 9}
+
+
+def test_qc_codes_are_committed_only_once_uploaded():
+    history = QcCodeHistory()
+    qc_codes = QcCodeUploads(history)
+    qc_codes.changes('a_qc', 0, {'PM_25_qcCode': 0}, 3600)
+    qc_codes.sent_to('a_qc', {'id': 1})
+    qc_codes.changes('b_qc', 0, {'PM_25_qcCode': 0}, 3600)
+    qc_codes.sent_to('b_qc', {'id': 2})
+
+    # Feed 2's upload failed, so its code is sent again next run.
+    qc_codes.commit(set([1]))
+    assert qc_codes.changes('a_qc', 300, {'PM_25_qcCode': 0}, 3600) == {}
+    assert qc_codes.changes('b_qc', 300, {'PM_25_qcCode': 0}, 3600) == {'PM_25_qcCode': 0}
+
+
+def test_qc_codes_are_shared_by_instances():
+    store = SharedStore()
+    first, second = QcCodeHistory(store), QcCodeHistory(store)
+    for history, epoch, code in ((first, 0, 0), (second, 300, 0), (first, 600, 9)):
+        qc_codes = QcCodeUploads(history)
+        qc_codes.changes('qc', epoch, {'PM_25_qcCode': code}, 3600)
+        qc_codes.commit(set())
+
+    # The first instance uploaded 0 -> 9, so going back to 0 is a change.
+    qc_codes = QcCodeUploads(second)
+    assert qc_codes.changes('qc', 900, {'PM_25_qcCode': 0}, 3600) == {'PM_25_qcCode': 0}
+
+
+NOW = 1589760000.0  # 2020-05-18 00:00:00 UTC
+
+
+def utc(epoch):
+    return datetime.utcfromtimestamp(epoch)
+
+
+def row(site_id, epoch):
+    return {'siteId': site_id, 'utc': utc(epoch).strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def test_watermarks_page_through_a_gap():
+    watermarks = SiteWatermarks()
+
+    # A new stream starts FIRST_WINDOW ago.
+    assert watermarks.windows('data', [1], NOW) == [(utc(NOW - 600), utc(NOW))]
+    watermarks.advance('data', utc(NOW), [row(1, NOW)])
+
+    # Ten hours later: four MAX_WINDOW windows this run, the rest next run.
+    later = NOW + 10 * 3600
+    windows = watermarks.windows('data', [1], later)
+    assert windows == [(utc(NOW + i * 7200), utc(NOW + (i + 1) * 7200)) for i in range(4)]
+    for _, end in windows:
+        watermarks.advance('data', end, [])
+    assert watermarks.windows('data', [1], later) == [(utc(NOW + 8 * 3600), utc(later))]
+
+
+def test_only_lagging_sites_widen_the_window():
+    watermarks = SiteWatermarks()
+    watermarks.advance('data', utc(NOW), [row(1, NOW - 120), row(2, NOW - 3600)])
+
+    # Site 1 is a couple of minutes late; site 2 is down and doesn't count.
+    assert watermarks.windows('data', [1, 2, 3], NOW + 60) == [(utc(NOW - 120), utc(NOW + 60))]
+    assert watermarks.windows('data', [2, 3], NOW + 60) == [(utc(NOW), utc(NOW + 60))]
+
+
+class SharedStore(object):
+    # Stands in for a DatastoreStore: every SnapshotDict over it reads and
+    # writes the same entries.
+    shared = True
+
+    def __init__(self):
+        self.entries = {}
+
+    def load(self, keys):
+        return dict((key, json.loads(self.entries[key])) for key in keys if key in self.entries)
+
+    def save(self, data, keys):
+        for key in keys:
+            self.entries[key] = json.dumps(data[key])
+
+
+def test_watermarks_are_shared_by_instances():
+    store = SharedStore()
+    SiteWatermarks(store).advance('data', utc(NOW), [row(1, NOW)])
+    SiteWatermarks(store).advance('wind', utc(NOW), [])
+
+    # A new instance starts where the others stopped, not FIRST_WINDOW ago.
+    watermarks = SiteWatermarks(store)
+    assert watermarks.windows('data', [1], NOW + 3600) == [(utc(NOW), utc(NOW + 3600))]
+    assert watermarks.windows('wind', [1], NOW + 3600) == [(utc(NOW), utc(NOW + 3600))]
+
+
+def test_windows_advance_only_when_committed(monkeypatch):
+    watermarks = SiteWatermarks()
+    monkeypatch.setattr(sonomatech, 'site_watermarks', watermarks)
+    uploader = FakeUploader()
+    uploader.fetched_windows = [('data', utc(NOW), [row(1, NOW - 60)]), ('wind', utc(NOW), [])]
+
+    # The data rows weren't all delivered, so that window is fetched again.
+    uploader.commit_windows(['wind'])
+    assert watermarks.windows('data', [1], NOW + 60) == [(utc(NOW + 60 - 600), utc(NOW + 60))]
+    assert watermarks.windows('wind', [1], NOW + 60) == [(utc(NOW), utc(NOW + 60))]
+    assert uploader.fetched_windows == []
@@ -0,0 +1,82 @@
+import calendar, datetime, pytz, threading
+
+from cache import LRUCache
+
+# Epoch seconds of midnight UTC, per 'YYYY-MM-DD' prefix.  A run sees only a
+# few distinct days, so this is cleared rather than evicted if it ever fills.
+MAX_DAYS = 10000
+_days = {}
+
+# Converted strings.  Sonoma Tech windows repeat one 'utc' string for every
+# site and parameter, so most conversions are a lookup.
+_epochs = LRUCache(max_size=10000)
+
+_timezones = {}
+_timezones_lock = threading.Lock()
+
+def get_timezone(name):
+    # pytz.timezone() validates and looks up the name on every call.
+    timezone = _timezones.get(name)
+    if timezone is None:
+        with _timezones_lock:
+            timezone = _timezones.setdefault(name, pytz.timezone(name))
+    return timezone
+
+def parse_utc(value):
+    # Epoch seconds of a UTC 'YYYY-MM-DD HH:MM:SS' string.  Any separators
+    # are accepted, as is a trailing 'Z', so ThingSpeak's
+    # 'YYYY-MM-DDTHH:MM:SSZ' and Rodeo's 'YYYY_MM_DD HH:MM:SS' parse too.
+    # Raises ValueError (or TypeError for None) when malformed; the time of
+    # day isn't range-checked.
+    if len(value) != 19 and not (len(value) == 20 and value[19] == 'Z'):
+        raise ValueError('Not a timestamp: %r' % (value,))
+    date = value[:10]
+    day = _days.get(date)
+    if day is None:
+        day = calendar.timegm(datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10])).timetuple())
+        if len(_days) >= MAX_DAYS:
+            _days.clear()
+        _days[date] = day
+    return float(day + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19]))
+
+def parse_utc_column(values):
+    # [parse_utc(value)] with None where malformed, inlined for long columns
+    # of distinct timestamps, which the memo wouldn't help.
+    days = _days
+    epochs = []
+    append = epochs.append
+    for value in values:
+        try:
+            length = len(value)
+            if length != 19 and (length != 20 or value[19] != 'Z'):
+                raise ValueError(value)
+            day = days.get(value[:10])
+            if day is None:
+                day = calendar.timegm(datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10])).timetuple())
+                if len(days) >= MAX_DAYS:
+                    days.clear()
+                days[value[:10]] = day
+            append(float(day + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])))
+        except (TypeError, ValueError):
+            append(None)
+    return epochs
+
+def utc_to_epoch(value):
+    # parse_utc, memoized.
+    epoch = _epochs.get(value)
+    if epoch is None:
+        epoch = parse_utc(value)
+        _epochs.set(value, epoch)
+    return epoch
+
+def local_to_epoch(value, timezone_name):
+    # Epoch seconds of a 'YYYY-MM-DD HH:MM:SS' wall-clock time in the given
+    # timezone.
+    key = (value, timezone_name)
+    epoch = _epochs.get(key)
+    if epoch is None:
+        naive = datetime.datetime.utcfromtimestamp(parse_utc(value))
+        aware = get_timezone(timezone_name).localize(naive)
+        epoch = float(calendar.timegm(aware.utctimetuple()))
+        _epochs.set(key, epoch)
+    return epoch
@@ -0,0 +1,11 @@
+from timeutil import local_to_epoch, parse_utc_column, utc_to_epoch
+
+
+def test_utc_formats():
+    assert utc_to_epoch('2020-05-17 22:14:23') == 1589753663.0
+    assert parse_utc_column(['2020-05-17T22:14:23Z', '2020-05-17T22:14', None]) == [1589753663.0, None, None]
+
+
+def test_local_time_follows_daylight_saving():
+    assert local_to_epoch('2020_05_17 15:14:23', 'America/Los_Angeles') == 1589753663.0
+    assert local_to_epoch('2020_01_17 15:14:23', 'America/Los_Angeles') == 1579302863.0
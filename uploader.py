@@ -1,25 +1,139 @@
+import threading, time
+
+from cache import JsonFileStore, LRUCache, SnapshotDict, cache_path
+
+# Feeds never move once created, so a resolution is good for a day.
+FEED_CACHE_TTL = 24 * 60 * 60
+
+class FeedCache(object):
+	# Resolved ESDR feeds keyed by product, serial number and lat/lon.  An
+	# in-process LRU sits in front of an optional JSON snapshot so warm
+	# requests, and new instances with a snapshot, skip the metadata lookups.
+	def __init__(self, max_size=5000, ttl=FEED_CACHE_TTL, path=None):
+		self.memory = LRUCache(max_size, ttl)
+		self.persisted = SnapshotDict(JsonFileStore(path))
+		self.ttl = ttl
+
+	def makeKey(self, product, id, lat, lon):
+		return '%s|%s|%s|%s' % (product['id'], id, lat, lon)
+
+	def get(self, key):
+		feed = self.memory.get(key)
+		if feed is None and self.persisted.store.path:
+			with self.persisted as persisted:
+				entry = persisted.get(key)
+			if entry and time.time() - entry['saved'] < self.ttl:
+				feed = entry['feed']
+				self.memory.set(key, feed)
+		return feed
+
+	def set(self, key, feed):
+		self.memory.set(key, feed)
+		if self.persisted.store.path:
+			with self.persisted as persisted:
+				persisted[key] = {'feed': feed, 'saved': time.time()}
+				self.persisted.save()
+
+	def invalidateFeed(self, feed_id):
+		for key, feed in self.memory.items():
+			if feed['id'] == feed_id:
+				self.memory.delete(key)
+		if self.persisted.store.path:
+			with self.persisted as persisted:
+				stale = [key for key, entry in persisted.items() if entry['feed']['id'] == feed_id]
+				for key in stale:
+					del persisted[key]
+				if stale:
+					self.persisted.save()
+
+feed_cache = FeedCache(path=cache_path('feeds.json'))
+
+# Device/feed indexes by product id, rebuilt when new feeds may have appeared.
+PRODUCT_INDEX_TTL = 60 * 60
+product_indexes = LRUCache(max_size=20, ttl=PRODUCT_INDEX_TTL)
+product_indexes_lock = threading.Lock()
+
+def invalidate_feed(feed_id):
+	# Forget a feed ESDR refused (deleted, or access lost) everywhere it is
+	# cached, so the next getFeed resolves it again.
+	feed_cache.invalidateFeed(feed_id)
+	for _, index in product_indexes.items():
+		index.remove_feed(feed_id)
+
+def merge_esdr_uploads(uploads):
+	# Combine several ESDR payloads for one feed into a single multi-row
+	# payload over the union of their channels.  Rows sharing a timestamp are
+	# merged; cells a payload doesn't cover are None (a no-op for ESDR).
+	channel_names = sorted(set(name for upload in uploads for name in upload['channel_names']))
+	columns = dict((name, i + 1) for i, name in enumerate(channel_names))
+	rows = {}
+	for upload in uploads:
+		indices = [columns[name] for name in upload['channel_names']]
+		for values in upload['data']:
+			row = rows.setdefault(values[0], [values[0]] + [None] * len(channel_names))
+			for index, value in zip(indices, values[1:]):
+				if value is not None:
+					row[index] = value
+	return {'channel_names': channel_names, 'data': [rows[time] for time in sorted(rows)]}
+
+def split_esdr_upload(esdr_data, max_rows):
+	# Yield esdr_data in payloads of at most max_rows rows each.
+	for start in range(0, len(esdr_data['data']), max_rows):
+		yield {'channel_names': esdr_data['channel_names'], 'data': esdr_data['data'][start:start + max_rows]}
+
 class Uploader(object):
 
 	def __init__(self, esdr, product):
 		self.esdr = esdr
 		self.product = product
-		self.feedCache = {}
+		# getFeed arguments by ESDR feed id, for refreshFeed.
+		self.feed_keys = {}
+
+	def getProductIndex(self):
+		index = product_indexes.get(self.product['id'])
+		if index is None:
+			with product_indexes_lock:
+				index = product_indexes.get(self.product['id'])
+				if index is None:
+					index = self.esdr.get_product_index(self.product)
+					product_indexes.set(self.product['id'], index)
+		return index
 
 	def getFeed(self, id, name, lat, lon):
-		if id in self.feedCache:
-			return self.feedCache[id]
-		device = self.esdr.get_device_by_serial_number(self.product, id)
+		key = feed_cache.makeKey(self.product, id, lat, lon)
+		feed = feed_cache.get(key)
+		if feed:
+			self.feed_keys[feed['id']] = (id, name, lat, lon)
+			return feed
+		index = self.getProductIndex()
+		device = index.get_device_by_serial_number(id)
 		if not device:
-			self.esdr.create_device(self.product, id, name=name)
 			device = self.esdr.get_device_by_serial_number(self.product, id)
+			if not device:
+				self.esdr.create_device(self.product, id, name=name)
+				device = self.esdr.get_device_by_serial_number(self.product, id)
+			index.add_device(device)
 
-		feed = self.esdr.get_feed(device)
+		feed = index.get_feed(device)
 		if not feed:
-			self.esdr.create_feed(device, lat=lat, lon=lon)
 			feed = self.esdr.get_feed(device)
-		self.feedCache[id] = feed
+			if not feed:
+				self.esdr.create_feed(device, lat=lat, lon=lon)
+				feed = self.esdr.get_feed(device)
+			index.add_feed(feed)
+		feed_cache.set(key, feed)
+		self.feed_keys[feed['id']] = (id, name, lat, lon)
 		return feed
 
+	def refreshFeed(self, feed):
+		# Resolve a feed again after ESDR refused an upload to it.  None if
+		# this uploader didn't resolve it.
+		invalidate_feed(feed['id'])
+		key = self.feed_keys.get(feed['id'])
+		if key is None:
+			return None
+		return self.getFeed(*key)
+
 	def makeId(self, deviceId, lat, lon):
 		id = '%s_%06d%s%06d%s' % (deviceId, round(1000 * abs(lat)), 'NS'[lat < 0], round(1000 * abs(lon)), 'EW'[lon < 0])
 		return id.replace('.','_')
@@ -30,4 +144,7 @@ class Uploader(object):
 		values = [data[key] for key in keys]
 
 		# TIME is implicit for ESDR;  don't list in channel_names
-		return {'channel_names':keys[1:], 'data':[values]}
\ No newline at end of file
+		return {'channel_names':keys[1:], 'data':[values]}
+
+	def mergeEsdrUploads(self, uploads):
+		return merge_esdr_uploads(uploads)
@@ -0,0 +1,57 @@
+from esdr import ProductIndex
+from uploader import Uploader
+
+
+def test_merge_esdr_uploads():
+    uploader = Uploader(None, None)
+    merged = uploader.mergeEsdrUploads([
+        {'channel_names': ['a', 'b'], 'data': [[20, 1, 2]]},
+        {'channel_names': ['c'], 'data': [[10, 3]]},
+        {'channel_names': ['a', 'c'], 'data': [[20, None, 4]]},
+    ])
+
+    assert merged == {
+        'channel_names': ['a', 'b', 'c'],
+        'data': [[10, None, None, 3],
+                 [20, 1, 2, 4]],
+    }
+
+
+class FakeEsdr(object):
+    # One device whose feed gets deleted; counts lookups.
+    def __init__(self):
+        self.device = {'id': 7, 'serialNumber': 'site_1', 'name': 'Site'}
+        self.feeds = [{'id': 70, 'deviceId': 7, 'latitude': 37.9, 'longitude': -122.3}]
+        self.calls = 0
+
+    def get_product_index(self, product):
+        self.calls += 1
+        return ProductIndex(product, [self.device], list(self.feeds))
+
+    def get_device_by_serial_number(self, product, serial_number):
+        self.calls += 1
+        return self.device
+
+    def get_feed(self, device):
+        self.calls += 1
+        return self.feeds[0] if self.feeds else None
+
+    def create_feed(self, device, lat=None, lon=None):
+        self.calls += 1
+        self.feeds.append({'id': 71, 'deviceId': 7, 'latitude': lat, 'longitude': lon})
+
+
+def test_refresh_feed_skips_the_cached_index():
+    esdr = FakeEsdr()
+    uploader = Uploader(esdr, {'id': 12345})
+    feed = uploader.getFeed('site_1', 'Site', 37.9, -122.3)
+    assert feed['id'] == 70
+    assert uploader.getFeed('site_1', 'Site', 37.9, -122.3) is feed
+
+    # The feed was deleted on ESDR and an upload to it was refused.
+    del esdr.feeds[:]
+    calls = esdr.calls
+    feed = uploader.refreshFeed(feed)
+    assert feed['id'] == 71
+    assert esdr.calls > calls
+    assert uploader.getFeed('site_1', 'Site', 37.9, -122.3)['id'] == 71
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+
+from cache import JsonFileStore, LRUCache, SnapshotDict, cache_path
+
+class UploadHistory(object):
+    # What has already been uploaded to each feed: the values sent for the most
+    # recent `max_rows` timestamps, plus the latest value of every channel.
+    # Sonoma Tech windows overlap from one minute to the next, so most rows a
+    # run scrapes were sent by an earlier run and can be dropped before upload.
+    def __init__(self, max_feeds=1000, max_rows=500, path=None):
+        self.max_feeds = max_feeds
+        self.max_rows = max_rows
+        self.feeds = SnapshotDict(JsonFileStore(path), decode=self.decode, encode=self.encode)
+        self.dirty = False
+
+    def decode(self, snapshot):
+        feeds = LRUCache(self.max_feeds)
+        for feed_id, state in snapshot.items():
+            rows = OrderedDict((time, values) for time, values in state['rows'])
+            feeds.set(int(feed_id), {'rows': rows, 'latest': state['latest']})
+        return feeds
+
+    def encode(self, feeds):
+        return dict((str(feed_id), {'rows': list(state['rows'].items()), 'latest': state['latest']})
+                    for feed_id, state in feeds.items())
+
+    def get_state(self, feeds, feed_id):
+        state = feeds.get(feed_id)
+        if state is None:
+            state = {'rows': OrderedDict(), 'latest': {}}
+            feeds.set(feed_id, state)
+        return state
+
+    def filter(self, feed_id, esdr_data, suppress_unchanged=False):
+        # Returns (esdr_data without already-sent values, rows dropped, values
+        # dropped).  With suppress_unchanged, values equal to the last one sent
+        # for that channel are dropped too, even at a new timestamp.
+        channel_names = esdr_data['channel_names']
+        with self.feeds as feeds:
+            state = self.get_state(feeds, feed_id)
+            rows = []
+            suppressed_rows = suppressed_values = 0
+            for row in esdr_data['data']:
+                sent = state['rows'].get(float(row[0]), {})
+                kept = [row[0]]
+                for channel, value in zip(channel_names, row[1:]):
+                    if value is not None and (sent.get(channel, None) == value or
+                                              (suppress_unchanged and state['latest'].get(channel, None) == value)):
+                        suppressed_values += 1
+                        value = None
+                    kept.append(value)
+                if any(value is not None for value in kept[1:]):
+                    rows.append(kept)
+                else:
+                    suppressed_rows += 1
+        # Drop channels that no longer carry any value.
+        columns = [i for i in range(len(channel_names)) if any(row[i + 1] is not None for row in rows)]
+        filtered = {
+            'channel_names': [channel_names[i] for i in columns],
+            'data': [[row[0]] + [row[i + 1] for i in columns] for row in rows]
+        }
+        return filtered, suppressed_rows, suppressed_values
+
+    def record(self, feed_id, esdr_data):
+        channel_names = esdr_data['channel_names']
+        with self.feeds as feeds:
+            state = self.get_state(feeds, feed_id)
+            sent_rows = state['rows']
+            for row in sorted(esdr_data['data'], key=lambda row: row[0]):
+                time = float(row[0])
+                sent = sent_rows.pop(time, {})
+                for channel, value in zip(channel_names, row[1:]):
+                    if value is not None:
+                        sent[channel] = value
+                        state['latest'][channel] = value
+                sent_rows[time] = sent
+            while len(sent_rows) > self.max_rows:
+                sent_rows.popitem(last=False)
+            self.dirty = True
+
+    def save(self):
+        if not self.feeds.store.path:
+            return
+        with self.feeds:
+            if not self.dirty:
+                return
+            self.feeds.save()
+            self.dirty = False
+
+upload_history = UploadHistory(path=cache_path('watermarks.json'))
@@ -0,0 +1,224 @@
+import math, threading
+
+from collections import deque
+
+from cache import JsonFileStore, SnapshotDict, snapshot_store
+
+MPH_PER_MS = 2.237
+
+def to_mph(speed, unit):
+    # Wind speed in miles per hour, or None for an unknown unit.
+    if unit == 'm/s':
+        return speed * MPH_PER_MS
+    if unit == 'mph':
+        return speed
+    return None
+
+class WindWindow(object):
+    # The samples of one feed in the last `window` seconds, with running sums
+    # for the mean speed and the vector mean direction and a monotonic queue
+    # for the max, so each sample costs O(1) amortized.
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        # (time, speed, direction, sample) in decreasing speed order.
+        self.gusts = deque()
+        self.speed_sum = 0.0
+        self.east_sum = 0.0
+        self.north_sum = 0.0
+        self.next_boundary = None
+        self.last_time = None
+
+    def push(self, time, speed, direction, sample):
+        radians = math.radians(direction)
+        east, north = speed * math.sin(radians), speed * math.cos(radians)
+        self.samples.append((time, speed, east, north, sample))
+        self.speed_sum += speed
+        self.east_sum += east
+        self.north_sum += north
+        while self.gusts and self.gusts[-1][1] <= speed:
+            self.gusts.pop()
+        self.gusts.append((time, speed, direction, sample))
+
+    def to_json(self):
+        return {
+            'samples': list(self.samples),
+            'gusts': list(self.gusts),
+            'sums': [self.speed_sum, self.east_sum, self.north_sum],
+            'next_boundary': self.next_boundary,
+            'last_time': self.last_time,
+        }
+
+    @staticmethod
+    def from_json(window, state):
+        wind_window = WindWindow(window)
+        if state:
+            wind_window.samples = deque(state['samples'])
+            wind_window.gusts = deque(state['gusts'])
+            wind_window.speed_sum, wind_window.east_sum, wind_window.north_sum = state['sums']
+            wind_window.next_boundary = state['next_boundary']
+            wind_window.last_time = state['last_time']
+        return wind_window
+
+    def evict(self, end):
+        # Drop samples at or before end - window.
+        start = end - self.window
+        while self.samples and self.samples[0][0] <= start:
+            _, speed, east, north, _ = self.samples.popleft()
+            self.speed_sum -= speed
+            self.east_sum -= east
+            self.north_sum -= north
+        while self.gusts and self.gusts[0][0] <= start:
+            self.gusts.popleft()
+        if not self.samples:
+            # Don't let rounding errors build up.
+            self.speed_sum = self.east_sum = self.north_sum = 0.0
+
+    def summary(self, end):
+        # Stats of the samples in (end - window, end].  The vector mean
+        # direction weights each sample's direction by its speed.
+        _, max_speed, gust_direction, gust_sample = self.gusts[0]
+        direction = math.degrees(math.atan2(self.east_sum, self.north_sum)) % 360
+        return {
+            'time': end,
+            'max_speed': max_speed,
+            'gust_direction': gust_direction,
+            'gust_sample': gust_sample,
+            'mean_speed': self.speed_sum / len(self.samples),
+            'vector_mean_direction': direction,
+            'samples': [sample for _, _, _, _, sample in self.samples],
+        }
+
+class WindAggregator(object):
+    # Streams wind samples per feed and emits the stats of the last `window`
+    # seconds at every multiple of `step` seconds that has samples.  Windows
+    # are kept across runs in `store` (memory by default), keyed by feed id,
+    # so one that straddles two runs is complete, and samples a run has
+    # already seen (overlapping request windows) are skipped.  A boundary is
+    # emitted once a sample after it arrives, so the newest one waits for the
+    # next run unless flushed.
+    def __init__(self, window=5 * 60, step=5 * 60, store=None):
+        self.window = window
+        self.step = step
+        self.windows = SnapshotDict(store or JsonFileStore(None))
+
+    def boundary_after(self, time):
+        # The first boundary at or after time.
+        return math.ceil(float(time) / self.step) * self.step
+
+    def snapshot(self, key):
+        # key's window, for a run to move forward on its own.
+        with self.windows.using([key]) as windows:
+            return WindWindow.from_json(self.window, windows.get(key))
+
+    def commit(self, windows):
+        # Replaces the stored windows of windows' keys with the given ones.
+        keys = list(windows)
+        with self.windows.using(keys) as stored:
+            for key, wind_window in windows.items():
+                stored[key] = wind_window.to_json()
+            self.windows.save(keys)
+
+    def add(self, key, time, speed, direction, sample=None):
+        # Adds one sample (samples of a feed must come in time order) and
+        # returns the summaries of the boundaries it completes.
+        with self.windows.using([key]) as windows:
+            wind_window = WindWindow.from_json(self.window, windows.get(key))
+            summaries = self.add_to(wind_window, time, speed, direction, sample)
+            windows[key] = wind_window.to_json()
+            self.windows.save([key])
+        return summaries
+
+    def add_to(self, wind_window, time, speed, direction, sample=None):
+        summaries = []
+        if wind_window.last_time is not None and time <= wind_window.last_time:
+            return summaries
+        if wind_window.next_boundary is None:
+            wind_window.next_boundary = self.boundary_after(time)
+        while time > wind_window.next_boundary:
+            wind_window.evict(wind_window.next_boundary)
+            if wind_window.samples:
+                summaries.append(wind_window.summary(wind_window.next_boundary))
+                wind_window.next_boundary += self.step
+            else:
+                # Skip the empty boundaries of a gap.
+                wind_window.next_boundary = self.boundary_after(time)
+        wind_window.push(time, speed, direction, sample)
+        wind_window.last_time = time
+        return summaries
+
+    def flush(self, key):
+        # The summary of the boundary still waiting for a later sample, if
+        # any.  Later samples go to the boundaries after it.
+        with self.windows.using([key]) as windows:
+            if key not in windows:
+                return None
+            wind_window = WindWindow.from_json(self.window, windows[key])
+            summary = self.flush_window(wind_window)
+            windows[key] = wind_window.to_json()
+            self.windows.save([key])
+        return summary
+
+    def flush_window(self, wind_window):
+        if wind_window is None or not wind_window.samples:
+            return None
+        end = wind_window.next_boundary
+        wind_window.evict(end)
+        summary = wind_window.summary(end) if wind_window.samples else None
+        wind_window.next_boundary += self.step
+        return summary
+
+class WindUploads(object):
+    # The windows one run moved forward, per feed, kept out of `aggregator`
+    # until that feed's rows are delivered, like sonomatech.QcCodeUploads: a
+    # summary that never reached ESDR or the outbox is emitted again when
+    # its samples are fetched again, instead of being skipped as seen.
+    def __init__(self, aggregator):
+        self.aggregator = aggregator
+        self.staged = {}
+        # Key -> the ESDR feed its summaries went to (None until one was
+        # looked up), for the keys with summaries to upload.
+        self.esdr_feeds = {}
+
+    def get_window(self, key):
+        wind_window = self.staged.get(key)
+        if wind_window is None:
+            wind_window = self.staged[key] = self.aggregator.snapshot(key)
+        return wind_window
+
+    def add(self, key, time, speed, direction, sample=None):
+        summaries = self.aggregator.add_to(self.get_window(key), time, speed, direction, sample)
+        if summaries:
+            self.esdr_feeds.setdefault(key, None)
+        return summaries
+
+    def flush(self, key):
+        summary = self.aggregator.flush_window(self.staged.get(key))
+        if summary:
+            self.esdr_feeds.setdefault(key, None)
+        return summary
+
+    def sent_to(self, key, esdr_feed):
+        self.esdr_feeds[key] = esdr_feed['id']
+
+    def commit(self, delivered_feeds):
+        # Keep the windows of the keys that had nothing to upload or whose
+        # ESDR feed is in delivered_feeds; forget the rest.
+        self.aggregator.commit(dict((key, wind_window) for key, wind_window in self.staged.items()
+                                    if key not in self.esdr_feeds or self.esdr_feeds[key] in delivered_feeds))
+        self.staged = {}
+        self.esdr_feeds = {}
+
+_aggregators = {}
+_aggregators_lock = threading.Lock()
+
+def get_wind_aggregator(name, window, step):
+    # The aggregator of a wind stream.  Its windows are shared by every
+    # instance, as the stream's fetch cursor is, so a run on a new or
+    # different instance finishes the windows an earlier run started instead
+    # of emitting partial ones.
+    with _aggregators_lock:
+        aggregator = _aggregators.get(name)
+        if aggregator is None:
+            aggregator = _aggregators[name] = WindAggregator(window, step, snapshot_store(name.replace('/', '_')))
+        return aggregator
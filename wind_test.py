@@ -0,0 +1,81 @@
+import json
+
+from wind import WindAggregator, WindUploads, to_mph
+
+
+def test_one_summary_per_boundary_across_runs():
+    aggregator = WindAggregator(window=300, step=300)
+
+    # First run: two samples before the 300 s boundary, nothing emitted yet.
+    assert aggregator.add('feed', 60, 10.0, 90) == []
+    assert aggregator.add('feed', 240, 20.0, 180) == []
+    # Next run re-sends the last sample, then crosses the boundary.
+    assert aggregator.add('feed', 240, 20.0, 180) == []
+    summaries = aggregator.add('feed', 360, 5.0, 0)
+
+    assert len(summaries) == 1
+    summary = summaries[0]
+    assert summary['time'] == 300
+    assert summary['max_speed'] == 20.0
+    assert summary['gust_direction'] == 180
+    assert summary['mean_speed'] == 15.0
+    # 10 mph east and 20 mph south average to a south-south-east wind.
+    assert 150 < summary['vector_mean_direction'] < 155
+
+    assert aggregator.flush('feed')['max_speed'] == 5.0
+
+
+def test_undelivered_summaries_are_emitted_again():
+    aggregator = WindAggregator(window=300, step=300)
+
+    def run(delivered_feeds):
+        uploads = WindUploads(aggregator)
+        summaries = []
+        for time, speed in ((240, 20.0), (360, 5.0)):
+            summaries += uploads.add('feed', time, speed, 90)
+        if summaries:
+            uploads.sent_to('feed', {'id': 1})
+        uploads.commit(delivered_feeds)
+        return summaries
+
+    # The upload failed: the same samples, fetched again, give the summary again.
+    assert [summary['time'] for summary in run(set())] == [300]
+    assert [summary['time'] for summary in run(set([1]))] == [300]
+    # Once delivered, they're skipped as seen.
+    assert run(set([1])) == []
+
+
+class SharedStore(object):
+    # Stands in for a DatastoreStore shared by several instances.
+    shared = True
+
+    def __init__(self):
+        self.entries = {}
+
+    def load(self, keys):
+        return dict((key, json.loads(self.entries[key])) for key in keys if key in self.entries)
+
+    def save(self, data, keys):
+        for key in keys:
+            self.entries[key] = json.dumps(data[key])
+
+
+def test_another_instance_finishes_the_window():
+    store = SharedStore()
+    first = WindUploads(WindAggregator(window=300, step=300, store=store))
+    assert first.add('feed', 60, 10.0, 90) == []
+    first.commit(set())
+
+    # A new instance gets the samples of the first run, not a partial window.
+    second = WindUploads(WindAggregator(window=300, step=300, store=store))
+    assert second.add('feed', 60, 10.0, 90) == []
+    assert second.add('feed', 240, 20.0, 90) == []
+    summaries = second.add('feed', 360, 5.0, 90)
+    assert summaries[0]['mean_speed'] == 15.0
+    assert len(summaries[0]['samples']) == 2
+
+
+def test_to_mph():
+    assert to_mph(1, 'm/s') == 2.237
+    assert to_mph(3, 'mph') == 3
+    assert to_mph(3, 'knots') is None